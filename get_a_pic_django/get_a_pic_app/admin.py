@@ -7,3 +7,5 @@ admin.site.register(UserProfile)
 admin.site.register(Plan)
 admin.site.register(Image)
 admin.site.register(ExpiringLink)
+admin.site.register(ThumbnailTask)
+admin.site.register(ThumbnailVariant)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class GetAPicAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'get_a_pic_app'
+
+    def ready(self):
+        from . import cleanup, entitlements, link_cache  # noqa: F401  (connect the file cleanup and cache signals)
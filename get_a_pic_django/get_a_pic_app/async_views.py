@@ -0,0 +1,116 @@
+# Async delivery views for ASGI deployments. A download in progress holds a coroutine rather than a worker thread,
+# so one process can stream to thousands of slow clients. They mirror the file-serving actions of the viewsets.
+
+from asgiref.sync import sync_to_async
+from django.core.files.storage import default_storage
+from django.http import JsonResponse
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .downloads import aserve_file, guess_content_type, negotiate_format, patch_thumbnail_caching
+from .entitlements import aget_entitlements
+from .link_cache import aresolve_link
+from .models import Image, Thumbnail
+from .signed_links import resolve_signed_link
+from .storage import thumbnail_storage
+from .tasks import get_or_render_thumbnail, get_or_render_variant
+
+
+def _detail(message, status):
+    return JsonResponse({"detail": message}, status=status)
+
+
+def _authenticate(request):
+    """Authenticate with the same classes as the DRF views (session and basic auth by default)."""
+    authenticators = [authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    return Request(request, authenticators=authenticators).user
+
+
+async def _authenticated_user(request):
+    """Return (user, None) for an authenticated request, or (None, error response) as IsAuthenticated would."""
+    user = await sync_to_async(_authenticate)(request)
+    if not user.is_authenticated:
+        return None, _detail("Authentication credentials were not provided.", 403)
+    return user, None
+
+
+async def _user_image(request, pk):
+    """Return (user, image, None) for the authenticated owner of image `pk`, or (None, None, error response)."""
+    user, error = await _authenticated_user(request)
+    if error is not None:
+        return None, None, error
+    image = await Image.objects.filter(pk=pk, user=user).afirst()
+    if image is None:
+        return None, None, _detail("Not found.", 404)
+    return user, image, None
+
+
+async def retrieve_by_token(request, token):
+    # Stored links need a logged-in client, as on ExpiringLinkViewSet; only signed links stand on their own.
+    _, error = await _authenticated_user(request)
+    if error is not None:
+        return error
+
+    link = await aresolve_link(token)
+    if link is None:
+        return _detail("Not found.", 404)
+
+    if link.content_type is None:
+        return _detail("Unsupported image format", 400)
+
+    return await aserve_file(request, default_storage, link.name, link.content_type)
+
+
+async def retrieve_signed(request, token):
+    link = resolve_signed_link(token)
+    if link is None:
+        return _detail("Not found.", 404)
+
+    if link.content_type is None:
+        return _detail("Unsupported image format", 400)
+
+    return await aserve_file(request, default_storage, link.name, link.content_type)
+
+
+async def image_thumbnail(request, pk, size):
+    user, image, error = await _user_image(request, pk)
+    if error is not None:
+        return error
+
+    entitlements = await aget_entitlements(user)
+    thumbnail_size = entitlements.get_thumbnail_size(size)
+    if thumbnail_size is None:
+        return _detail("This thumbnail size is not available on your plan", 403)
+
+    thumbnail = await Thumbnail.objects.filter(image=image, thumbnail_size=thumbnail_size,
+                                               status=Thumbnail.READY).afirst()
+    if thumbnail is None:
+        thumbnail = await sync_to_async(get_or_render_thumbnail)(image, thumbnail_size)
+    if thumbnail.status != Thumbnail.READY:
+        response = _detail("The thumbnail is being rendered, try again shortly", 202)
+        response['Retry-After'] = '10'
+        return response
+    file_path = thumbnail.file_path
+    fmt = negotiate_format(request.META.get('HTTP_ACCEPT', ''), entitlements.thumbnail_formats)
+    if fmt is not None:
+        variant = await sync_to_async(get_or_render_variant)(thumbnail, fmt, entitlements.thumbnail_quality)
+        file_path = variant.file_path
+
+    response = await aserve_file(request, thumbnail_storage(), file_path, guess_content_type(file_path))
+    patch_thumbnail_caching(request, response, thumbnail)
+    return response
+
+
+async def image_original(request, pk):
+    user, image, error = await _user_image(request, pk)
+    if error is not None:
+        return error
+
+    if not (await aget_entitlements(user)).has_original_image_link:
+        return _detail("The original image is not available on your plan", 403)
+
+    name = image.image_file.name
+    content_type = guess_content_type(name)
+    if content_type is None:
+        return _detail("Unsupported image format", 400)
+    return await aserve_file(request, default_storage, name, content_type)
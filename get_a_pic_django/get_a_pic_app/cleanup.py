@@ -0,0 +1,192 @@
+import logging
+import os
+import posixpath
+import threading
+import time
+import weakref
+from collections import namedtuple
+from datetime import timedelta
+from itertools import islice
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .metrics import storage_files_deleted_total, timed
+from .models import Image, Thumbnail, ThumbnailVariant
+from .storage import local_path, thumbnail_storage
+
+logger = logging.getLogger(__name__)
+
+# Names checked against the database per query.
+BATCH_SIZE = 1000
+
+ReconcileResult = namedtuple('ReconcileResult', ['scanned', 'orphans', 'recent', 'deleted'])
+
+_pending = threading.local()
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def referenced_originals(names):
+    return set(Image.objects.filter(image_file__in=names).values_list('image_file', flat=True))
+
+
+def referenced_thumbnails(names):
+    referenced = set(Thumbnail.objects.filter(file_path__in=names).values_list('file_path', flat=True))
+    referenced.update(ThumbnailVariant.objects.filter(file_path__in=names).values_list('file_path', flat=True))
+    return referenced
+
+
+def _areas():
+    """(storage, top directory, function returning the referenced names among a batch) for each kind of file."""
+    return [
+        (default_storage, 'uploaded_images', referenced_originals),
+        (thumbnail_storage(), 'thumbnails', referenced_thumbnails),
+    ]
+
+
+def _delete(storage, name):
+    try:
+        storage.delete(name)
+    except Exception:
+        logger.exception("Could not delete %s; reconcile_storage will retry", name)
+        return False
+    storage_files_deleted_total.inc()
+    return True
+
+
+def delete_unused_files(originals=(), thumbnails=()):
+    """
+    Delete the named originals and thumbnails that no row refers to; returns how many were deleted.
+
+    Identical uploads share one original and identical renders share thumbnail files, so a file is only deleted
+    once its last row is gone.
+    """
+    deleted = 0
+    for (storage, _, referenced), names in zip(_areas(), (originals, thumbnails)):
+        for batch in _batches(set(names), BATCH_SIZE):
+            for name in set(batch) - referenced(batch):
+                deleted += _delete(storage, name)
+    return deleted
+
+
+class _PendingDeletes:
+    """The files deleted during one transaction; called once it commits."""
+
+    def __init__(self):
+        self.originals, self.thumbnails, self.done = set(), set(), False
+
+    def __call__(self):
+        self.done = True
+        delete_unused_files(self.originals, self.thumbnails)
+
+
+def delete_files_on_commit(originals=(), thumbnails=()):
+    """
+    Delete the named files, when unused, once the current transaction commits.
+
+    The names gathered during a transaction are checked and deleted together by one commit callback. Only a weak
+    reference to it is kept here, so when a rollback discards the callback, the next delete registers a new one;
+    the rolled back rows still exist, so their files are kept.
+    """
+    pending = _pending.ref() if hasattr(_pending, 'ref') else None
+    if pending is None or pending.done:
+        pending = _PendingDeletes()
+        pending.originals.update(originals)
+        pending.thumbnails.update(thumbnails)
+        _pending.ref = weakref.ref(pending)
+        transaction.on_commit(pending)
+    else:
+        pending.originals.update(originals)
+        pending.thumbnails.update(thumbnails)
+
+
+@receiver(post_delete, sender=Image)
+def delete_original_file(sender, instance, **kwargs):
+    if instance.image_file:
+        delete_files_on_commit(originals=[instance.image_file.name])
+
+
+@receiver(post_delete, sender=Thumbnail)
+@receiver(post_delete, sender=ThumbnailVariant)
+def delete_thumbnail_file(sender, instance, **kwargs):
+    if instance.file_path:
+        delete_files_on_commit(thumbnails=[instance.file_path])
+
+
+def _scan(directory, path):
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return
+    subdirectories = []
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.name)
+            else:
+                yield posixpath.join(path, entry.name)
+    for name in subdirectories:
+        yield from _scan(os.path.join(directory, name), posixpath.join(path, name))
+
+
+def walk_storage(storage, path):
+    """
+    Yield the names of the files under `path` as they are listed: local directories are read entry by entry and
+    object stores page by page, so even a flat directory of millions of files is never held in memory.
+    """
+    if hasattr(storage, 'iter_files'):
+        yield from storage.iter_files(path)
+        return
+    directory = local_path(storage, path)
+    if directory is not None:
+        yield from _scan(directory, path)
+        return
+    try:
+        directories, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield posixpath.join(path, name)
+    for directory in directories:
+        yield from walk_storage(storage, posixpath.join(path, directory))
+
+
+def reconcile_storage(batch_size=None, min_age=3600, dry_run=False, pause=0.0):
+    """
+    Walk `uploaded_images/` and `thumbnails/` and delete the files no row refers to.
+
+    The listing is streamed and checked against the database `batch_size` names at a time, so memory does not
+    grow with the number of files. Orphans modified less than `min_age` seconds ago are kept: they may belong to
+    an upload or render whose row is not committed yet.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    cutoff = timezone.now() - timedelta(seconds=min_age)
+    scanned = orphans = recent = deleted = 0
+    with timed('reconcile_storage'):
+        for storage, directory, referenced in _areas():
+            for batch in _batches(walk_storage(storage, directory), batch_size):
+                scanned += len(batch)
+                for name in set(batch) - referenced(batch):
+                    orphans += 1
+                    try:
+                        modified = storage.get_modified_time(name) if min_age else None
+                    except FileNotFoundError:
+                        continue
+                    if modified is not None and modified > cutoff:
+                        recent += 1
+                    elif not dry_run:
+                        deleted += _delete(storage, name)
+                if pause:
+                    time.sleep(pause)
+    return ReconcileResult(scanned, orphans, recent, deleted)
@@ -0,0 +1,225 @@
+import asyncio
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from PIL import features
+
+from .storage import content_version, local_path
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+}
+# Most compact first; used for Accept negotiation of thumbnail variants.
+VARIANT_PREFERENCE = ['avif', 'webp']
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def guess_content_type(path):
+    _, extension = os.path.splitext(path)
+    return CONTENT_TYPES.get(extension.lower())
+
+
+def negotiate_format(accept, offered):
+    """
+    Pick the preferred variant format from `offered` that the Accept header names explicitly.
+
+    Wildcards are ignored: browsers that can decode WebP or AVIF list them by name.
+    """
+    accepted = set()
+    for part in accept.split(','):
+        media_type, _, params = part.strip().partition(';')
+        quality = params.strip().replace(' ', '')
+        if quality.startswith('q=') and quality[2:] in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(media_type.strip().lower())
+    for fmt in VARIANT_PREFERENCE:
+        if fmt in offered and f"image/{fmt}" in accepted and features.check(fmt):
+            return fmt
+    return None
+
+
+def patch_thumbnail_caching(request, response, thumbnail):
+    """
+    Cache headers for a thumbnail served by the negotiating endpoint, in whichever format the Accept header chose.
+
+    Requested with the thumbnail's content version as `v`, as the API links it, the response is immutable: a
+    re-render changes the version and so the URL. Otherwise it is revalidated with its ETag.
+    """
+    patch_vary_headers(response, ['Accept'])
+    version = request.GET.get('v')
+    if version and version == content_version(thumbnail.file_path):
+        patch_cache_control(response, private=True, max_age=settings.MEDIA_IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+
+
+def parse_range(header, size):
+    """
+    Return the inclusive (start, end) of a single byte range, or None when the header should be ignored.
+
+    Multi-range requests are answered with the full file, which RFC 9110 allows.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _open(storage, name, path):
+    return open(path, 'rb') if path is not None else storage.open(name)
+
+
+def _read_range(file, start, length):
+    with file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def _aread_range(storage, name, path, start, length):
+    """_read_range for ASGI: file I/O runs in worker threads, so slow clients only hold a coroutine."""
+    file = await asyncio.to_thread(_open, storage, name, path)
+    try:
+        await asyncio.to_thread(file.seek, start)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+def _offload_response(storage, name, path, content_type):
+    if settings.FILE_DELIVERY_MODE == 'redirect':
+        return HttpResponseRedirect(storage.url(name))
+    response = HttpResponse(content_type=content_type)
+    if settings.FILE_DELIVERY_MODE == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = quote(settings.FILE_DELIVERY_ACCEL_PREFIX + name)
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+def _stat(storage, name):
+    """Return (local path or None, size, mtime in ns) of a stored file."""
+    path = local_path(storage, name)
+    try:
+        if path is not None:
+            stat = os.stat(path)
+            return path, stat.st_size, stat.st_mtime_ns
+        return None, storage.size(name), int(storage.get_modified_time(name).timestamp() * 1_000_000_000)
+    except FileNotFoundError:
+        raise Http404("File not found")
+
+
+def _file_response(request, storage, name, content_type, stat, body):
+    """
+    Answer conditional, offloaded and range requests for a stored file with the given `stat`.
+
+    `body(path, start, length, whole)` builds the response that actually transfers the bytes.
+    """
+    path, size, mtime_ns = stat
+    etag = f'"{mtime_ns:x}-{size:x}"'
+    last_modified = mtime_ns // 1_000_000_000
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    # Local files are never redirected to: their storage URL may well be the view serving them.
+    if path is None and settings.FILE_DELIVERY_MODE == 'redirect' or \
+            path is not None and settings.FILE_DELIVERY_MODE in ('x-accel-redirect', 'x-sendfile'):
+        response = _offload_response(storage, name, path, content_type)
+    else:
+        byte_range = None
+        if 'HTTP_RANGE' in request.META and _if_range_matches(request, etag, last_modified):
+            try:
+                byte_range = parse_range(request.META['HTTP_RANGE'], size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f"bytes */{size}"
+                return response
+
+        if byte_range is None:
+            response = body(path, 0, size, True)
+        else:
+            start, end = byte_range
+            response = body(path, start, end - start + 1, False)
+            response.status_code = 206
+            response['Content-Range'] = f"bytes {start}-{end}/{size}"
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def serve_file(request, storage, name, content_type):
+    """
+    Serve a stored file without reading it into memory.
+
+    Local files go through FileResponse so the WSGI server can use sendfile via wsgi.file_wrapper; files in object
+    storage are streamed through. FILE_DELIVERY_MODE hands the transfer over instead: 'x-accel-redirect' or
+    'x-sendfile' to the front-end server for local files, 'redirect' to the storage's own URL for the others.
+    """
+    def body(path, start, length, whole):
+        if whole:
+            return FileResponse(_open(storage, name, path), content_type=content_type)
+        response = StreamingHttpResponse(_read_range(_open(storage, name, path), start, length),
+                                         content_type=content_type)
+        response['Content-Length'] = str(length)
+        return response
+
+    return _file_response(request, storage, name, content_type, _stat(storage, name), body)
+
+
+async def aserve_file(request, storage, name, content_type):
+    """serve_file for async views: the file is streamed from an async iterator instead of a blocking file."""
+    def body(path, start, length, whole):
+        response = StreamingHttpResponse(_aread_range(storage, name, path, start, length),
+                                         content_type=content_type)
+        response['Content-Length'] = str(length)
+        return response
+
+    stat = await asyncio.to_thread(_stat, storage, name)
+    return _file_response(request, storage, name, content_type, stat, body)
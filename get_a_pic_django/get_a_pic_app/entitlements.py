@@ -0,0 +1,142 @@
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .link_cache import LRUCache
+from .models import Plan, ThumbnailSize, UserProfile
+
+PLAN_KEY_PREFIX = 'plan-entitlements:'
+USER_KEY_PREFIX = 'user-plan:'
+# Cached for users without a plan; plan ids start at 1.
+NO_PLAN = 0
+
+
+class Entitlements(namedtuple('Entitlements', [
+        'plan_id', 'plan_name', 'thumbnail_sizes', 'has_original_image_link', 'can_generate_expiring_link',
+        'thumbnail_formats', 'thumbnail_quality'])):
+    """What a plan allows, compiled from its Plan and ThumbnailSize rows. `thumbnail_sizes` is sorted by size."""
+
+    @classmethod
+    def from_plan(cls, plan):
+        return cls(
+            plan_id=plan.id,
+            plan_name=plan.name,
+            thumbnail_sizes=tuple(sorted(plan.thumbnail_sizes.all(), key=lambda size: size.size)),
+            has_original_image_link=plan.has_original_image_link,
+            can_generate_expiring_link=plan.can_generate_expiring_link,
+            thumbnail_formats=tuple(plan.get_thumbnail_formats()),
+            thumbnail_quality=plan.thumbnail_quality,
+        )
+
+    def get_thumbnail_size(self, size):
+        """The ThumbnailSize for `size` pixels, or None when the plan does not include it."""
+        return next((thumbnail_size for thumbnail_size in self.thumbnail_sizes if thumbnail_size.size == size), None)
+
+
+NO_ENTITLEMENTS = Entitlements(None, None, (), False, False, (), None)
+
+local_cache = LRUCache(settings.ENTITLEMENTS_LOCAL_MAXSIZE)
+
+
+def _cached(key, load):
+    value = local_cache.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is None:
+            value = load()
+            cache.set(key, value, settings.ENTITLEMENTS_CACHE_TIMEOUT)
+        local_cache.set(key, value, settings.ENTITLEMENTS_LOCAL_TIMEOUT)
+    return value
+
+
+def _load_plan(plan_id):
+    plan = Plan.objects.prefetch_related('thumbnail_sizes').filter(pk=plan_id).first()
+    return NO_ENTITLEMENTS if plan is None else Entitlements.from_plan(plan)
+
+
+def get_plan_entitlements(plan_id):
+    if plan_id is None or plan_id == NO_PLAN:
+        return NO_ENTITLEMENTS
+    return _cached(PLAN_KEY_PREFIX + str(plan_id), lambda: _load_plan(plan_id))
+
+
+def get_entitlements(user):
+    """The Entitlements of `user`'s plan; no database queries once cached."""
+    def load_plan_id():
+        plan_id = UserProfile.objects.filter(user_id=user.pk).values_list('plan_id', flat=True).first()
+        return plan_id or NO_PLAN
+
+    return get_plan_entitlements(_cached(USER_KEY_PREFIX + str(user.pk), load_plan_id))
+
+
+async def aget_entitlements(user):
+    """get_entitlements for async views; answered without leaving the event loop when the local tier has it."""
+    plan_id = local_cache.get(USER_KEY_PREFIX + str(user.pk))
+    if plan_id is not None:
+        entitlements = NO_ENTITLEMENTS if plan_id == NO_PLAN else local_cache.get(PLAN_KEY_PREFIX + str(plan_id))
+        if entitlements is not None:
+            return entitlements
+    return await sync_to_async(get_entitlements)(user)
+
+
+def invalidate_plan(plan_id):
+    key = PLAN_KEY_PREFIX + str(plan_id)
+    local_cache.delete(key)
+    cache.delete(key)
+
+
+def invalidate_user(user_id):
+    key = USER_KEY_PREFIX + str(user_id)
+    local_cache.delete(key)
+    cache.delete(key)
+
+
+def invalidate_on_commit(invalidate, ids):
+    """
+    Call `invalidate` for each of `ids` now, so that the current transaction reads its own changes, and again once
+    it commits: until then other requests still read the old rows and may cache them for the full timeout.
+    """
+    ids = list(ids)
+
+    def invalidate_all():
+        for id_ in ids:
+            invalidate(id_)
+
+    invalidate_all()
+    transaction.on_commit(invalidate_all)
+
+
+@receiver(post_save, sender=Plan)
+@receiver(post_delete, sender=Plan)
+def invalidate_changed_plan(sender, instance, **kwargs):
+    invalidate_on_commit(invalidate_plan, [instance.pk])
+
+
+@receiver(m2m_changed, sender=Plan.thumbnail_sizes.through)
+def invalidate_plan_sizes(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_on_commit(invalidate_plan, [instance.pk])
+    else:
+        # Changed from the ThumbnailSize side; a clear() does not say which plans were affected.
+        plan_ids = pk_set if pk_set is not None else Plan.objects.values_list('id', flat=True)
+        invalidate_on_commit(invalidate_plan, plan_ids)
+
+
+@receiver(post_save, sender=ThumbnailSize)
+@receiver(post_delete, sender=ThumbnailSize)
+def invalidate_changed_size(sender, instance, **kwargs):
+    # Deleting a size removes it from plans without an m2m_changed signal.
+    invalidate_on_commit(invalidate_plan, Plan.objects.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_changed_profile(sender, instance, **kwargs):
+    invalidate_on_commit(invalidate_user, [instance.user_id])
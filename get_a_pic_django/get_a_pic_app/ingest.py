@@ -0,0 +1,84 @@
+import hashlib
+import warnings
+from collections import namedtuple
+
+from django.conf import settings
+from PIL import ExifTags, Image as PilImage
+
+ALLOWED_FORMATS = {
+    'JPEG': ('jpg', 'jpeg'),
+    'PNG': ('png',),
+}
+
+ImageInfo = namedtuple('ImageInfo', ['format', 'width', 'height', 'orientation'])
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def content_hash(file):
+    """SHA-256 of `file`, reusing the digest computed by the upload handlers when there is one."""
+    digest = getattr(file, 'content_hash', None)
+    if digest:
+        return digest
+    hasher = hashlib.sha256()
+    for chunk in file.chunks():
+        hasher.update(chunk)
+    file.seek(0)
+    return hasher.hexdigest()
+
+
+def exif_orientation(img):
+    """The EXIF orientation of `img`, 1 to 8; 1 when it has none. Only reads EXIF already parsed from the header."""
+    if 'exif' not in img.info:
+        return 1
+    try:
+        orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in range(1, 9) else 1
+
+
+def perceptual_hash(img):
+    """
+    64-bit difference hash of `img`, as 16 hex digits. Resizing or recompressing a picture flips few of its bits,
+    so near-duplicates have hashes a small Hamming distance apart.
+    """
+    pixels = img.convert('L').resize((9, 8), PilImage.Resampling.BOX).tobytes()
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = bits << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return f"{bits:016x}"
+
+
+def inspect_image(file):
+    """
+    Read the format and dimensions from the image header without decoding any pixel data.
+
+    The pixel-count check runs before anything is decoded, so decompression bombs are rejected up front.
+    """
+    file.seek(0)
+    try:
+        with warnings.catch_warnings():
+            # The size limit is enforced below with IMAGE_MAX_PIXELS.
+            warnings.simplefilter('ignore', PilImage.DecompressionBombWarning)
+            with PilImage.open(file, formats=list(ALLOWED_FORMATS)) as img:
+                info = ImageInfo(img.format, img.width, img.height, exif_orientation(img))
+    except PilImage.DecompressionBombError:
+        raise InvalidImage(f"Image is too large; the limit is {settings.IMAGE_MAX_PIXELS} pixels")
+    except Exception:
+        raise InvalidImage("Invalid or corrupted image")
+    finally:
+        file.seek(0)
+
+    if info.width * info.height > settings.IMAGE_MAX_PIXELS:
+        raise InvalidImage(f"Image is too large ({info.width}x{info.height}); "
+                           f"the limit is {settings.IMAGE_MAX_PIXELS} pixels")
+
+    file_extension = file.name.split('.')[-1].lower()
+    if file_extension not in ALLOWED_FORMATS[info.format]:
+        raise InvalidImage("File content does not match its extension")
+
+    return info
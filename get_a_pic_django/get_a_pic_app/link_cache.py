@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .downloads import guess_content_type
+from .models import ExpiringLink
+
+CACHE_KEY_PREFIX = 'expiring-link:v2:'
+# Stored for tokens that do not exist, so scans for bad tokens never reach the database twice.
+MISSING = 'missing'
+
+
+class ResolvedLink(namedtuple('ResolvedLink', ['name', 'content_type', 'expires_at'])):
+    """An expiring link resolved to the stored name of its original."""
+
+
+class LRUCache:
+    """A small thread-safe LRU whose entries also carry their own deadline."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, deadline = item
+            if deadline <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cache = LRUCache(settings.LINK_CACHE_LOCAL_MAXSIZE)
+
+
+def _live_links(token):
+    # Expired rows are filtered out by the query itself; they resolve like unknown tokens.
+    return ExpiringLink.objects.select_related('image').filter(link=token, expiration_date__gt=timezone.now())
+
+
+def _load(token):
+    return _entry(_live_links(token).first())
+
+
+async def _aload(token):
+    return _entry(await _live_links(token).afirst())
+
+
+def _entry(expiring_link):
+    if expiring_link is None:
+        return MISSING
+    name = expiring_link.image.image_file.name
+    return ResolvedLink(name, guess_content_type(name), expiring_link.expiration_date.timestamp())
+
+
+def _timeout(entry):
+    if entry == MISSING:
+        return settings.LINK_CACHE_NEGATIVE_TIMEOUT
+    # Never let an entry outlive the link itself.
+    return min(entry.expires_at - time.time(), settings.LINK_CACHE_TIMEOUT)
+
+
+def resolve_link(token):
+    """
+    Return the ResolvedLink for `token`, or None if the token is unknown or expired.
+
+    Only unexpired links are loaded and cached entries never outlive the link, so callers need no expiry check.
+    """
+    key = CACHE_KEY_PREFIX + token
+    entry = local_cache.get(key)
+    if entry is None:
+        entry = cache.get(key)
+        if entry is None:
+            entry = _load(token)
+            cache.set(key, entry, _timeout(entry))
+        local_cache.set(key, entry, min(_timeout(entry), settings.LINK_CACHE_LOCAL_TIMEOUT))
+    return None if entry == MISSING else entry
+
+
+async def aresolve_link(token):
+    """resolve_link for async views."""
+    key = CACHE_KEY_PREFIX + token
+    entry = local_cache.get(key)
+    if entry is None:
+        entry = await cache.aget(key)
+        if entry is None:
+            entry = await _aload(token)
+            await cache.aset(key, entry, _timeout(entry))
+        local_cache.set(key, entry, min(_timeout(entry), settings.LINK_CACHE_LOCAL_TIMEOUT))
+    return None if entry == MISSING else entry
+
+
+def invalidate_link(token):
+    key = CACHE_KEY_PREFIX + token
+    local_cache.delete(key)
+    cache.delete(key)
+
+
+@receiver(post_save, sender=ExpiringLink)
+@receiver(post_delete, sender=ExpiringLink)
+def invalidate_changed_link(sender, instance, **kwargs):
+    invalidate_link(instance.link)
@@ -0,0 +1,90 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from get_a_pic_app.models import Image
+from get_a_pic_app.tasks import enqueue_missing_thumbnails, process_tasks
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _write_checkpoint(path, checkpoint):
+    # Write and rename, so an interrupted run never leaves a truncated checkpoint behind.
+    with open(path + '.tmp', 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(path + '.tmp', path)
+
+
+class Command(BaseCommand):
+    help = "Render the thumbnails that images are missing for their owner's plan, resuming from a checkpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Images scanned per chunk; the checkpoint advances after each chunk")
+        parser.add_argument('--processes', type=int, default=settings.THUMBNAIL_WORKER_PROCESSES,
+                            help="Number of processes rendering each chunk")
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep between chunks, to spread the load on the database and storage")
+        parser.add_argument('--plan', type=int, default=None,
+                            help="Only scan images of users on the plan with this id")
+        parser.add_argument('--enqueue-only', action='store_true',
+                            help="Only queue the missing thumbnails for the running workers")
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, 'backfill_thumbnails.json'),
+                            help="File recording the last image id done, so that a new run continues from it")
+        parser.add_argument('--restart', action='store_true',
+                            help="Ignore the checkpoint and scan the whole library again")
+
+    def handle(self, *args, **options):
+        checkpoint = None if options['restart'] else _read_checkpoint(options['checkpoint'])
+        if checkpoint is None or checkpoint.get('plan') != options['plan']:
+            checkpoint = {'plan': options['plan'], 'last_image_id': 0, 'images': 0, 'queued': 0, 'failed': 0}
+        elif checkpoint['last_image_id']:
+            self.stdout.write(f"Resuming after image {checkpoint['last_image_id']}")
+
+        images = Image.objects.order_by('id')
+        if options['plan'] is not None:
+            images = images.filter(user__profile__plan_id=options['plan'])
+        remaining = images.filter(id__gt=checkpoint['last_image_id']).count()
+        started = time.monotonic()
+        done = 0
+
+        while True:
+            chunk = list(images.filter(id__gt=checkpoint['last_image_id'])
+                         .values_list('id', flat=True)[:options['batch_size']])
+            if not chunk:
+                break
+
+            tasks = enqueue_missing_thumbnails(Image.objects.filter(id__in=chunk))
+            if tasks and not options['enqueue_only']:
+                results = process_tasks([task.id for task in tasks], processes=options['processes'])
+                checkpoint['failed'] += results.count(False)
+
+            checkpoint['last_image_id'] = chunk[-1]
+            checkpoint['images'] += len(chunk)
+            checkpoint['queued'] += len(tasks)
+            _write_checkpoint(options['checkpoint'], checkpoint)
+
+            done += len(chunk)
+            remaining = max(remaining, done)
+            rate = done / max(time.monotonic() - started, 1e-9)
+            self.stdout.write(f"{done}/{remaining} images ({done / remaining:.1%}), "
+                              f"{len(tasks)} in this chunk needed rendering, {rate:.1f} images/s, "
+                              f"about {(remaining - done) / rate:.0f}s left")
+
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        # A finished run starts over next time, e.g. after the next plan change.
+        if os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+        self.stdout.write(f"Done: {checkpoint['images']} images scanned, {checkpoint['queued']} needed rendering, "
+                          f"{checkpoint['failed']} of them failed or were left to the workers")
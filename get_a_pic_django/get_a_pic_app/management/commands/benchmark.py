@@ -0,0 +1,287 @@
+import io
+import json
+import platform
+import secrets
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import timedelta
+
+import django
+import PIL
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image as PilImage
+from rest_framework.test import APIClient
+
+from get_a_pic_app.models import ExpiringLink, Image, Plan, Thumbnail, ThumbnailSize, User
+
+PLANS = {
+    'Basic': {'sizes': [200]},
+    'Premium': {'sizes': [200, 400], 'has_original_image_link': True},
+    'Enterprise': {'sizes': [200, 400], 'has_original_image_link': True, 'can_generate_expiring_link': True},
+}
+FORMATS = {'jpeg': ('JPEG', 'jpg'), 'png': ('PNG', 'png')}
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def _timings(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _summary(timings):
+    return {
+        'runs': len(timings),
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'min_ms': round(min(timings) * 1000, 3),
+        'max_ms': round(max(timings) * 1000, 3),
+    }
+
+
+def _synthetic_image(megapixels, image_format):
+    """A photo-like test image: smooth gradients plus noise, so encoders have real work to do."""
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    gradient = PilImage.radial_gradient('L').resize((width, height))
+    noise = PilImage.effect_noise((width, height), 40)
+    img = PilImage.merge('RGB', (gradient, noise, PilImage.linear_gradient('L').resize((width, height))))
+    buffer = io.BytesIO()
+    img.save(buffer, image_format)
+    return buffer.getvalue(), (width, height)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark thumbnailing, image listing, uploads and expiring-link serving, and write JSON results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help="Write results to this JSON file instead of stdout")
+        parser.add_argument('--compare', help="Previous results file to compare medians against")
+        parser.add_argument('--megapixels', type=_int_list, default=[1, 12, 40],
+                            help="Comma separated source image sizes for the thumbnail benchmark")
+        parser.add_argument('--formats', default='jpeg,png', help="Comma separated source formats: jpeg, png")
+        parser.add_argument('--library-sizes', type=_int_list, default=[10, 100, 1000],
+                            help="Comma separated library sizes for the listing benchmark")
+        parser.add_argument('--upload-megapixels', type=int, default=12,
+                            help="Source image size for the upload and expiring-link benchmarks")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per measurement")
+        parser.add_argument('--use-current-db', action='store_true',
+                            help="Run against the configured database instead of a throwaway test database; "
+                                 "the benchmark's own plans, users and images are deleted afterwards")
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        media_root = tempfile.mkdtemp(prefix='get_a_pic_bench_')
+        old_db_name = None
+        try:
+            setup_test_environment()
+            environment_set_up = True
+        except RuntimeError:
+            # Already inside a test run.
+            environment_set_up = False
+        try:
+            if not options['use_current_db']:
+                old_db_name = connection.settings_dict['NAME']
+                connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            with override_settings(MEDIA_ROOT=media_root, THUMBNAIL_TASKS_EAGER=False):
+                self._setup_fixtures()
+                try:
+                    results = []
+                    results += self.bench_thumbnails(options['megapixels'], options['formats'].split(','))
+                    results += self.bench_listing(options['library_sizes'])
+                    results += self.bench_upload(options['upload_megapixels'])
+                    results += self.bench_expiring_link(options['upload_megapixels'])
+                finally:
+                    self._teardown_fixtures()
+        finally:
+            if old_db_name is not None:
+                connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            if environment_set_up:
+                teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        report = {
+            'meta': {
+                'timestamp': timezone.now().isoformat(),
+                'commit': _git_commit(),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'pillow': PIL.__version__,
+                'repeat': self.repeat,
+            },
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            self._compare(options['compare'], results)
+
+    def _setup_fixtures(self):
+        # With --use-current-db the database may hold real plans and users: everything the benchmark creates is
+        # named after this run and only that is changed or deleted.
+        self.prefix = f"bench-{secrets.token_hex(4)}"
+        sizes = {}
+        self.created_sizes = []
+        for size in (200, 400):
+            sizes[size], created = ThumbnailSize.objects.get_or_create(size=size)
+            if created:
+                self.created_sizes.append(sizes[size])
+        self.plans = {}
+        for name, config in PLANS.items():
+            plan = Plan.objects.create(
+                name=f"{self.prefix}-{name}",
+                has_original_image_link=config.get('has_original_image_link', False),
+                can_generate_expiring_link=config.get('can_generate_expiring_link', False),
+            )
+            plan.thumbnail_sizes.set([sizes[size] for size in config['sizes']])
+            self.plans[name] = plan
+        self.sizes = list(sizes.values())
+
+    def _teardown_fixtures(self):
+        # Deleting the users deletes their images, thumbnails and links, and their files with them.
+        User.objects.filter(username__startswith=f"{self.prefix}-").delete()
+        Plan.objects.filter(pk__in=[plan.pk for plan in self.plans.values()]).delete()
+        ThumbnailSize.objects.filter(pk__in=[size.pk for size in self.created_sizes]).delete()
+
+    def _user(self, username, plan_name):
+        user = User.objects.create_user(username=f"{self.prefix}-{username}-{time.monotonic_ns()}", password='bench')
+        user.profile.plan = self.plans[plan_name]
+        user.profile.save()
+        client = APIClient()
+        client.force_authenticate(user=user)
+        return user, client
+
+    def bench_thumbnails(self, megapixels_list, formats):
+        user, _ = self._user('thumbs', 'Enterprise')
+        results = []
+        for fmt in formats:
+            pil_format, extension = FORMATS[fmt]
+            for megapixels in megapixels_list:
+                content, dimensions = _synthetic_image(megapixels, pil_format)
+                image = Image.objects.create(user=user, image_file=ContentFile(content, name=f"bench.{extension}"))
+                timings = _timings(lambda: image.create_thumbnails(self.sizes), self.repeat)
+                summary = _summary(timings)
+                summary['images_per_second'] = round(1 / statistics.median(timings), 3)
+                results.append({
+                    'name': 'create_thumbnails',
+                    'params': {'format': fmt, 'megapixels': megapixels, 'dimensions': dimensions,
+                               'bytes': len(content), 'sizes': [size.size for size in self.sizes]},
+                    **summary,
+                })
+                self.stderr.write(f"create_thumbnails {fmt} {megapixels}MP: {summary['median_ms']} ms")
+        return results
+
+    def bench_listing(self, library_sizes):
+        content, _ = _synthetic_image(1, 'JPEG')
+        results = []
+        for library_size in library_sizes:
+            user, client = self._user('list', 'Premium')
+            template = Image.objects.create(user=user, image_file=ContentFile(content, name='bench.jpg'))
+            template.create_thumbnails(self.sizes)
+            images = Image.objects.bulk_create([
+                Image(user=user, image_file=template.image_file.name, content_hash=template.content_hash)
+                for _ in range(library_size - 1)
+            ])
+            Thumbnail.objects.bulk_create([
+                Thumbnail(image=image, thumbnail_size=thumbnail.thumbnail_size, file_path=thumbnail.file_path,
+                          status=Thumbnail.READY)
+                for image in images for thumbnail in template.thumbnails.all()
+            ])
+
+            url = reverse('image-list')
+            client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url)
+            assert response.status_code == 200, response.data
+            query_count = len(queries.captured_queries)
+            timings = _timings(lambda: client.get(url), self.repeat)
+            results.append({
+                'name': 'image_list',
+                'params': {'library_size': library_size},
+                'queries': query_count,
+                **_summary(timings),
+            })
+            self.stderr.write(f"image_list {library_size} images: {results[-1]['median_ms']} ms, "
+                              f"{results[-1]['queries']} queries")
+        return results
+
+    def bench_upload(self, megapixels):
+        content, _ = _synthetic_image(megapixels, 'JPEG')
+        results = []
+        for plan_name in PLANS:
+            _, client = self._user('upload', plan_name)
+
+            def upload():
+                image_file = SimpleUploadedFile(name='bench.jpg', content=content, content_type='image/jpeg')
+                response = client.post(reverse('image-list'), {'image_file': image_file}, format='multipart')
+                assert response.status_code == 201, response.data
+
+            results.append({
+                'name': 'upload',
+                'params': {'plan': plan_name, 'megapixels': megapixels, 'bytes': len(content)},
+                **_summary(_timings(upload, self.repeat)),
+            })
+            self.stderr.write(f"upload {plan_name}: {results[-1]['median_ms']} ms")
+        return results
+
+    def bench_expiring_link(self, megapixels):
+        content, _ = _synthetic_image(megapixels, 'JPEG')
+        user, client = self._user('link', 'Enterprise')
+        image = Image.objects.create(user=user, image_file=ContentFile(content, name='bench.jpg'))
+        link = ExpiringLink.objects.create(image=image, expiration_date=timezone.now() + timedelta(hours=1))
+        url = reverse('expiringlink-retrieve-by-token', args=[link.link])
+
+        def retrieve():
+            response = client.get(url)
+            for _ in response.streaming_content:
+                pass
+
+        requests = self.repeat * 20
+        timings = _timings(retrieve, requests)
+        summary = _summary(timings)
+        summary['requests_per_second'] = round(requests / sum(timings), 3)
+        self.stderr.write(f"retrieve_by_token: {summary['requests_per_second']} req/s")
+        return [{'name': 'retrieve_by_token', 'params': {'megapixels': megapixels, 'bytes': len(content)}, **summary}]
+
+    def _compare(self, path, results):
+        with open(path) as file:
+            previous = {self._key(result): result for result in json.load(file)['results']}
+        for result in results:
+            before = previous.get(self._key(result))
+            if before is None:
+                continue
+            ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+            self.stderr.write(f"{result['name']} {json.dumps(result['params'], sort_keys=True)}: "
+                              f"{before['median_ms']} -> {result['median_ms']} ms ({ratio:.2f}x)")
+
+    @staticmethod
+    def _key(result):
+        return result['name'], json.dumps(result['params'], sort_keys=True)
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from get_a_pic_app.metrics import expired_links_purged_total, read_textfile_value, write_textfile
+from get_a_pic_app.tasks import purge_expired_links
+
+
+class Command(BaseCommand):
+    help = "Delete expired links in small batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.EXPIRING_LINK_PURGE_BATCH_SIZE,
+                            help="Rows deleted per batch (and per transaction)")
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep between batches, to spread the load on the database")
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help="Stop after this many batches; the next run picks up the rest")
+        parser.add_argument('--metrics-file', default=settings.EXPIRING_LINK_PURGE_METRICS_FILE,
+                            help="Prometheus textfile (for node_exporter's textfile collector) to add the purged "
+                                 "count to; the command exits before any scrape of its own process")
+
+    def handle(self, *args, **options):
+        purged = purge_expired_links(batch_size=options['batch_size'], pause=options['pause'],
+                                     max_batches=options['max_batches'])
+        if options['metrics_file']:
+            # The counter only lives as long as this process, so carry the total over from the previous run.
+            total = read_textfile_value(options['metrics_file'], expired_links_purged_total.name)
+            expired_links_purged_total.inc(total - expired_links_purged_total.value() + purged)
+            write_textfile(options['metrics_file'], [expired_links_purged_total])
+        self.stdout.write(f"Purged {purged} expired link(s)")
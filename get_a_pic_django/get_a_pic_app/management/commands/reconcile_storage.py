@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from get_a_pic_app.cleanup import BATCH_SIZE, reconcile_storage
+
+
+class Command(BaseCommand):
+    help = "Delete original and thumbnail files that no row refers to"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help="Listed files checked against the database per query")
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help="Keep orphans modified less than this many seconds ago, as their row may be "
+                                 "about to be committed")
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep between batches, to spread the load on the database and storage")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the orphans")
+
+    def handle(self, *args, **options):
+        result = reconcile_storage(batch_size=options['batch_size'], min_age=options['min_age'],
+                                   dry_run=options['dry_run'], pause=options['pause'])
+        self.stdout.write(f"Scanned {result.scanned} file(s): {result.orphans} orphan(s), {result.recent} too recent "
+                          f"to delete, {result.deleted} deleted")
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from get_a_pic_app.models import ThumbnailTask
+from get_a_pic_app.tasks import run_worker_pool
+
+
+class Command(BaseCommand):
+    help = "Render pending thumbnails from the database task queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.THUMBNAIL_WORKER_PROCESSES,
+                            help="Number of worker processes")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once the queue is empty instead of polling")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait between polls of an empty queue")
+        parser.add_argument('--queue', choices=[queue for queue, _ in ThumbnailTask.QUEUE_CHOICES],
+                            default=ThumbnailTask.DEFAULT_QUEUE,
+                            help="Queue to take tasks from; 'large' holds images over THUMBNAIL_MEMORY_BUDGET")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Starting {options['processes']} thumbnail worker(s) on the {options['queue']} queue")
+        run_worker_pool(options['processes'], once=options['once'], poll_interval=options['poll_interval'],
+                        queue=options['queue'])
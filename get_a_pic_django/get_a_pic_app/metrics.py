@@ -0,0 +1,145 @@
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds; a final +Inf bucket is implied.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Span durations of the request being handled, collected by PerformanceMiddleware.
+current_spans = ContextVar('current_spans', default=None)
+
+
+class Counter:
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value:g}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(tuple(sorted(labels.items())), ([0], 0.0))
+        return counts[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', str(bound)),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total:g}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
+
+
+requests_total = Counter('getapic_requests_total', "HTTP requests handled.")
+request_duration = Histogram('getapic_request_duration_seconds', "Time spent handling HTTP requests.")
+db_queries_total = Counter('getapic_db_queries_total', "SQL queries executed while handling requests.")
+db_seconds_total = Counter('getapic_db_seconds_total', "Time spent in SQL queries while handling requests.")
+span_duration = Histogram('getapic_span_duration_seconds', "Time spent in instrumented steps, per request or task.")
+profiles_total = Counter('getapic_profiles_captured_total', "cProfile dumps written for slow requests.")
+expired_links_purged_total = Counter('getapic_expired_links_purged_total', "Expired links deleted by purges.")
+storage_files_deleted_total = Counter('getapic_storage_files_deleted_total',
+                                      "Original and thumbnail files deleted after their last row.")
+large_images_deferred_total = Counter('getapic_large_images_deferred_total',
+                                      "Renders moved to the large-image queue for exceeding the memory budget.")
+
+REGISTRY = [requests_total, request_duration, db_queries_total, db_seconds_total, span_duration, profiles_total,
+            expired_links_purged_total, storage_files_deleted_total, large_images_deferred_total]
+
+
+def render_metrics():
+    """The registry in the Prometheus text exposition format."""
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def read_textfile_value(path, name):
+    """The unlabelled sample `name` in the textfile at `path`, or 0 if the file or sample is missing."""
+    try:
+        with open(path) as file:
+            for line in file:
+                sample, _, value = line.partition(' ')
+                if sample == name:
+                    return float(value)
+    except FileNotFoundError:
+        pass
+    return 0
+
+
+def write_textfile(path, metrics):
+    """
+    Write `metrics` to `path` for node_exporter's textfile collector.
+
+    The file is replaced atomically, so the collector never reads a half-written one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as file:
+        file.write('\n'.join(line for metric in metrics for line in metric.render()) + '\n')
+    os.chmod(file.name, 0o644)
+    os.replace(file.name, path)
+
+
+@contextmanager
+def timed(name):
+    """
+    Time the block as the span `name`.
+
+    Inside a request the duration is added to the request's spans, which the middleware reports once per request;
+    elsewhere (workers, management commands) it is observed directly.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        spans = current_spans.get()
+        if spans is None:
+            span_duration.observe(elapsed, span=name)
+        else:
+            spans[name] += elapsed
@@ -0,0 +1,106 @@
+import cProfile
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecorder:
+    """A database execute wrapper counting queries and the time spent in them."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+class PerformanceMiddleware:
+    """
+    Per-request instrumentation, enabled with PERF_INSTRUMENTATION_ENABLED.
+
+    Reports SQL count and time plus the spans recorded with `metrics.timed` (thumbnail rendering, PIL decode and
+    encode, serialization) in a Server-Timing header, and aggregates them for the /metrics endpoint. A sample of
+    requests is profiled; profiles of those slower than PERF_SLOW_REQUEST_THRESHOLD are written to PERF_PROFILE_DIR.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PERF_INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        spans = defaultdict(float)
+        token = metrics.current_spans.set(spans)
+        profiler = cProfile.Profile() if random.random() < settings.PERF_PROFILE_SAMPLE_RATE else None
+        start = time.perf_counter()
+        try:
+            with self._wrap_connections(recorder):
+                if profiler is None:
+                    response = self.get_response(request)
+                else:
+                    response = profiler.runcall(self.get_response, request)
+        finally:
+            metrics.current_spans.reset(token)
+        duration = time.perf_counter() - start
+
+        view = self._view_name(request)
+        metrics.requests_total.inc(view=view, method=request.method, status=response.status_code)
+        metrics.request_duration.observe(duration, view=view, method=request.method)
+        metrics.db_queries_total.inc(recorder.count, view=view)
+        metrics.db_seconds_total.inc(recorder.duration, view=view)
+        for name, elapsed in spans.items():
+            metrics.span_duration.observe(elapsed, span=name)
+
+        response['Server-Timing'] = self._server_timing(duration, recorder, spans)
+        if profiler is not None and duration >= settings.PERF_SLOW_REQUEST_THRESHOLD:
+            self._dump_profile(profiler, request, view, duration)
+        return response
+
+    @staticmethod
+    def _wrap_connections(recorder):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        return stack
+
+    @staticmethod
+    def _view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved'
+        return match.view_name or match._func_path
+
+    @staticmethod
+    def _server_timing(duration, recorder, spans):
+        entries = [f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries"']
+        entries += [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in spans.items()]
+        entries.append(f"total;dur={duration * 1000:.1f}")
+        return ', '.join(entries)
+
+    @staticmethod
+    def _dump_profile(profiler, request, view, duration):
+        os.makedirs(settings.PERF_PROFILE_DIR, exist_ok=True)
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{view.replace(':', '_')}-{int(duration * 1000)}ms.prof"
+        path = os.path.join(settings.PERF_PROFILE_DIR, filename)
+        profiler.dump_stats(path)
+        metrics.profiles_total.inc()
+        logger.warning("Slow request %s %s took %.0f ms, profile written to %s",
+                       request.method, request.path, duration * 1000, path)
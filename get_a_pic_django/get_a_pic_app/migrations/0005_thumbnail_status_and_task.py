@@ -0,0 +1,58 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0004_alter_expiringlink_expiration_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='thumbnail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='thumbnail',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='file_path',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.AddConstraint(
+            model_name='thumbnail',
+            constraint=models.UniqueConstraint(fields=('image', 'thumbnail_size'), name='unique_thumbnail_per_size'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailtask',
+            name='image',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thumbnail_tasks', to='get_a_pic_app.image'),
+        ),
+        migrations.AddIndex(
+            model_name='thumbnailtask',
+            index=models.Index(fields=['status', 'id'], name='thumbnailtask_status_idx'),
+        ),
+    ]
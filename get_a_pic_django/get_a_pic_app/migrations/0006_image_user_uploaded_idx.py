@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0005_thumbnail_status_and_task'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', '-uploaded_at', '-id'], name='image_user_uploaded_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:14
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0007_image_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plan',
+            name='thumbnail_formats',
+            field=models.CharField(blank=True, default='webp', help_text="Comma separated extra formats served to clients that accept them, e.g. 'avif,webp'", max_length=50),
+        ),
+        migrations.AddField(
+            model_name='plan',
+            name='thumbnail_quality',
+            field=models.PositiveSmallIntegerField(default=80, help_text='Encoder quality for the extra formats', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.CreateModel(
+            name='ThumbnailVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(choices=[('webp', 'WebP'), ('avif', 'AVIF')], max_length=10)),
+                ('file_path', models.CharField(max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('thumbnail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='get_a_pic_app.thumbnail')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='thumbnailvariant',
+            constraint=models.UniqueConstraint(fields=('thumbnail', 'format'), name='unique_variant_per_format'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0008_thumbnail_formats_and_variants'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expiringlink',
+            index=models.Index(fields=['expiration_date'], name='expiringlink_expiration_idx'),
+        ),
+    ]
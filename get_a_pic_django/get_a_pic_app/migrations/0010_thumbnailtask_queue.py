@@ -0,0 +1,26 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0009_expiringlink_expiration_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='thumbnailtask',
+            name='thumbnailtask_status_idx',
+        ),
+        migrations.AddField(
+            model_name='thumbnailtask',
+            name='queue',
+            field=models.CharField(choices=[('default', 'Default'), ('large', 'Large images')], default='default', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='thumbnailtask',
+            index=models.Index(fields=['queue', 'status', 'id'], name='thumbnailtask_queue_status_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0010_thumbnailtask_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='byte_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='format',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='orientation',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash',
+            field=models.CharField(blank=True, db_index=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'width', 'height'], name='image_user_dimensions_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'byte_size'], name='image_user_byte_size_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:11
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0011_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='jpeg_optimize',
+            field=models.BooleanField(default=True, help_text='Compute optimal Huffman tables for JPEG thumbnails; smaller, same pixels'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='jpeg_progressive',
+            field=models.BooleanField(default=True, help_text='Encode JPEG thumbnails progressively; usually smaller above a few kilobytes'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='jpeg_quality',
+            field=models.PositiveSmallIntegerField(default=75, help_text='Encoder quality of JPEG thumbnails', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(95)]),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='keep_metadata',
+            field=models.BooleanField(default=False, help_text="Keep the original's ICC profile and EXIF data instead of converting to sRGB and dropping them"),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='png_compress_level',
+            field=models.PositiveSmallIntegerField(default=9, help_text='zlib level of PNG thumbnails, 0 (fastest) to 9 (smallest); the pixels are the same', validators=[django.core.validators.MaxValueValidator(9)]),
+        ),
+    ]
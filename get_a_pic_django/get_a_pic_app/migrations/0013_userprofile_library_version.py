@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0012_thumbnail_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='library_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:34
+
+from django.db import migrations, models
+import get_a_pic_app.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('get_a_pic_app', '0013_userprofile_library_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='plan',
+            name='thumbnail_formats',
+            field=models.CharField(blank=True, default='webp', help_text="Comma separated extra formats served to clients that accept them, e.g. 'avif,webp'", max_length=50, validators=[get_a_pic_app.models.validate_thumbnail_formats]),
+        ),
+    ]
@@ -1,26 +1,155 @@
+import hashlib
+import io
+import os
 import secrets
 from django.utils import timezone
 
-from django.db import models
+from django.db import models, transaction
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import User
-from PIL import Image as PilImage
-from django.conf import settings
-from django.db.models.signals import post_save
+from PIL import ExifTags, Image as PilImage
+from django.core.files import File
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
+from .ingest import InvalidImage, content_hash, exif_orientation, inspect_image, perceptual_hash
+from .metrics import timed
+from .storage import thumbnail_storage, versioned_name
+
+
+# Use JPEG DCT scaling when the original is at least this many times taller than the largest thumbnail.
+THUMBNAIL_DRAFT_RATIO = 2
+THUMBNAIL_REDUCING_GAP = 3.0
+
+# Transpositions that turn an image with each EXIF orientation upright. Orientations 5 to 8 swap width and height.
+ORIENTATION_TRANSPOSE = {
+    2: PilImage.Transpose.FLIP_LEFT_RIGHT,
+    3: PilImage.Transpose.ROTATE_180,
+    4: PilImage.Transpose.FLIP_TOP_BOTTOM,
+    5: PilImage.Transpose.TRANSPOSE,
+    6: PilImage.Transpose.ROTATE_270,
+    7: PilImage.Transpose.TRANSVERSE,
+    8: PilImage.Transpose.ROTATE_90,
+}
+
+
+class ImageTooLarge(Exception):
+    """Decoding the original would take more memory than the renderer's budget allows."""
+
+
+def decode_memory(img, source_size):
+    """Bytes needed to decode `img` at its current size (after any draft) from an original of `source_size`."""
+    if img.mode in ('1', 'L', 'P'):
+        pixel_bytes = 1
+    elif img.mode.startswith('I;16'):
+        pixel_bytes = 2
+    else:
+        # RGB, RGBA, LA, CMYK, I and F are all stored with four bytes per pixel.
+        pixel_bytes = 4
+    memory = img.width * img.height * pixel_bytes
+    if img.format == 'JPEG' and img.info.get('progressive'):
+        # libjpeg keeps the DCT coefficients of the whole image for progressive scans, whatever the scale.
+        width, height = source_size
+        memory += width * height * len(img.getbands()) * 2
+    return memory
+
+
+def to_srgb(img):
+    """
+    Convert `img` from its embedded ICC profile to sRGB, the colour space browsers assume for untagged images.
+
+    Images without a profile, in modes other than RGB, RGBA or CMYK, or with a profile littlecms cannot read are
+    returned unchanged.
+    """
+    icc_profile = img.info.get('icc_profile')
+    if not icc_profile or img.mode not in ('RGB', 'RGBA', 'CMYK'):
+        return img
+    try:
+        from PIL import ImageCms
+    except ImportError:
+        return img
+    try:
+        return ImageCms.profileToProfile(img, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                                         ImageCms.createProfile('sRGB'),
+                                         outputMode='RGBA' if img.mode == 'RGBA' else 'RGB')
+    except (ImageCms.PyCMSError, OSError):
+        return img
+
+
+def store_image(img, name, file_format, **params):
+    """
+    Encode `img` and save it in the thumbnail storage; returns the stored name.
+
+    A digest of the encoded bytes goes into the name, so a re-rendered thumbnail gets a new URL and every URL can
+    be cached forever.
+    """
+    buffer = io.BytesIO()
+    with timed('pil_encode'):
+        img.save(buffer, file_format, **params)
+    buffer.seek(0)
+    name = versioned_name(name, hashlib.sha256(buffer.getbuffer()).hexdigest())
+    return thumbnail_storage().save(name, File(buffer, name))
+
 
 class ThumbnailSize(models.Model):
     size = models.PositiveIntegerField(unique=True)
+    jpeg_quality = models.PositiveSmallIntegerField(
+        default=75, validators=[MinValueValidator(1), MaxValueValidator(95)],
+        help_text="Encoder quality of JPEG thumbnails"
+    )
+    jpeg_progressive = models.BooleanField(
+        default=True, help_text="Encode JPEG thumbnails progressively; usually smaller above a few kilobytes"
+    )
+    jpeg_optimize = models.BooleanField(
+        default=True, help_text="Compute optimal Huffman tables for JPEG thumbnails; smaller, same pixels"
+    )
+    png_compress_level = models.PositiveSmallIntegerField(
+        default=9, validators=[MaxValueValidator(9)],
+        help_text="zlib level of PNG thumbnails, 0 (fastest) to 9 (smallest); the pixels are the same"
+    )
+    keep_metadata = models.BooleanField(
+        default=False,
+        help_text="Keep the original's ICC profile and EXIF data instead of converting to sRGB and dropping them"
+    )
+
+    def encoder_params(self, file_format):
+        """Pillow save() options for thumbnails of this size in `file_format`."""
+        if file_format == 'JPEG':
+            return {'quality': self.jpeg_quality, 'progressive': self.jpeg_progressive,
+                    'optimize': self.jpeg_optimize}
+        if file_format == 'PNG':
+            return {'compress_level': self.png_compress_level}
+        return {}
 
     def __str__(self):
         return f"{self.size}px"
 
 
+def validate_thumbnail_formats(value):
+    formats = [fmt.strip().lower() for fmt in value.split(',') if fmt.strip()]
+    unknown = sorted(set(formats) - {fmt for fmt, _ in ThumbnailVariant.FORMAT_CHOICES})
+    if unknown:
+        raise ValidationError(f"Unknown thumbnail formats: {', '.join(unknown)}")
+
+
 class Plan(models.Model):
     name = models.CharField(max_length=255, unique=True)
     thumbnail_sizes = models.ManyToManyField(ThumbnailSize, blank=True)
     has_original_image_link = models.BooleanField(default=False)
     can_generate_expiring_link = models.BooleanField(default=False)
+    thumbnail_formats = models.CharField(
+        max_length=50, blank=True, default='webp', validators=[validate_thumbnail_formats],
+        help_text="Comma separated extra formats served to clients that accept them, e.g. 'avif,webp'"
+    )
+    thumbnail_quality = models.PositiveSmallIntegerField(
+        default=80, validators=[MinValueValidator(1), MaxValueValidator(100)],
+        help_text="Encoder quality for the extra formats"
+    )
+
+    def get_thumbnail_formats(self):
+        return [fmt.strip().lower() for fmt in self.thumbnail_formats.split(',') if fmt.strip()]
 
     def __str__(self):
         return self.name
@@ -29,10 +158,16 @@ class Plan(models.Model):
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     plan = models.ForeignKey(Plan, on_delete=models.SET_NULL, null=True, blank=True)
+    # Bumped by every write to the user's images or thumbnails; the image list ETag is built from it.
+    library_version = models.PositiveBigIntegerField(default=0)
 
     def __str__(self):
         return self.user.username
 
+    @classmethod
+    def bump_library_version(cls, user_ids):
+        cls.objects.filter(user_id__in=user_ids).update(library_version=F('library_version') + 1)
+
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -44,51 +179,325 @@ class Image(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="images")
     image_file = models.ImageField(upload_to="uploaded_images/")
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    # Read from the header at upload, so listing and filtering never open the file. Width and height are those
+    # of the stored pixels, before any EXIF `orientation` is applied.
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, blank=True)
+    byte_size = models.PositiveBigIntegerField(null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(default=1)
+    # Difference hash of the picture, set by the first render; see ingest.perceptual_hash.
+    phash = models.CharField(max_length=16, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-uploaded_at', '-id'], name='image_user_uploaded_idx'),
+            models.Index(fields=['user', 'width', 'height'], name='image_user_dimensions_idx'),
+            models.Index(fields=['user', 'byte_size'], name='image_user_byte_size_idx'),
+        ]
+
+    @classmethod
+    def from_upload(cls, user, upload):
+        return cls.from_uploads(user, [upload])[0]
+
+    @classmethod
+    def from_uploads(cls, user, uploads):
+        """
+        Build unsaved Images, storing each distinct content once and reusing identical stored originals.
+
+        Call it inside the transaction that saves the images: the rows whose originals are reused stay locked until
+        it commits, so deleting them waits for the new rows, and the file cleanup after the delete sees them.
+        """
+        digests = [content_hash(upload) for upload in uploads]
+        stored = {digest: (name, phash) for digest, name, phash
+                  in cls.objects.select_for_update().filter(content_hash__in=set(digests)).order_by('-id')
+                  .values_list('content_hash', 'image_file', 'phash')}
+        images = []
+        for upload, digest in zip(uploads, digests):
+            image = cls(user=user, content_hash=digest)
+            image.set_metadata(upload)
+            if digest in stored:
+                image.image_file, image.phash = stored[digest]
+            else:
+                image.image_file.save(upload.name, upload, save=False)
+                stored[digest] = (image.image_file.name, '')
+            images.append(image)
+        return images
+
+    def set_metadata(self, upload):
+        """Fill the metadata columns from the header of `upload`, as read by the upload validation or now."""
+        info = getattr(upload, 'image_info', None)
+        if info is None:
+            try:
+                info = inspect_image(upload)
+            except InvalidImage:
+                info = None
+        self.byte_size = upload.size
+        if info is None:
+            info = ('', None, None, 1)
+        self.format, self.width, self.height, self.orientation = info
+
+    def save(self, *args, **kwargs):
+        previous_file = None
+        if self.image_file and not self.image_file._committed:
+            # A new file, including one replacing the previous file on update: the old hash would dedup later
+            # uploads of the old content onto this file.
+            self.content_hash = content_hash(self.image_file.file)
+            self.set_metadata(self.image_file.file)
+            # The next render hashes the new picture.
+            self.phash = ''
+            if self.pk is not None:
+                previous_file = Image.objects.filter(pk=self.pk).values_list('image_file', flat=True).first()
+        if previous_file is None:
+            super().save(*args, **kwargs)
+            UserProfile.bump_library_version([self.user_id])
+            return
+
+        from .cleanup import delete_files_on_commit
+        from .tasks import enqueue_thumbnails
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # The thumbnails and variants show the previous picture, and would be reused for uploads of the new
+            # one: they are deleted, their files once the transaction commits, and rendered again.
+            self.thumbnails.all().delete()
+            delete_files_on_commit(originals=[previous_file])
+            enqueue_thumbnails(self)
+            UserProfile.bump_library_version([self.user_id])
 
     def create_thumbnail(self, size):
-        try:
-            img = PilImage.open(self.image_file)
+        return self.create_thumbnails([size])[size]
 
-            aspect = img.width / img.height
-            new_width = int(size * aspect)
+    def create_thumbnails(self, sizes, memory_budget=None):
+        """
+        Render all `sizes` (ints or ThumbnailSize) from one decode of the original, largest first.
 
-            img = img.resize((new_width, size))
+        With a `memory_budget` (bytes), ImageTooLarge is raised from the image header, before anything is decoded,
+        when the decoded original would not fit.
+        """
+        with timed('create_thumbnails'):
+            return self._create_thumbnails(sizes, memory_budget)
 
-            file_extension = self.image_file.name.split('.')[-1].lower()
+    def _create_thumbnails(self, sizes, memory_budget):
+        paths = {}
+        try:
+            thumbnail_sizes = {size.size: size for size in sizes if isinstance(size, ThumbnailSize)}
+            wanted = [size for size in sizes if not isinstance(size, ThumbnailSize)]
+            if wanted:
+                thumbnail_sizes.update((size.size, size) for size in ThumbnailSize.objects.filter(size__in=wanted))
+            missing = set(wanted) - set(thumbnail_sizes)
+            if missing:
+                raise ThumbnailSize.DoesNotExist(f"Unknown thumbnail sizes: {sorted(missing)}")
 
-            thumb_path = f"thumbnails/{self.id}_{size}.{file_extension}"
+            file_extension = self.image_file.name.split('.')[-1].lower()
             file_format = file_extension.upper()
             if file_format == "JPG":
                 file_format = "JPEG"
 
-            img.save(f"{settings.MEDIA_ROOT}/{thumb_path}", file_format)
+            with self.image_file.open('rb') as original, PilImage.open(original) as img:
+                source_size = img.size
+                source_format = img.format
+                orientation = exif_orientation(img)
+                # Sizes are heights of the upright picture. Thumbnails are resized in the stored orientation and
+                # turned upright afterwards, so only small images are ever transposed.
+                swapped = orientation >= 5
+                aspect = img.height / img.width if swapped else img.width / img.height
 
-            thumbnail_size = ThumbnailSize.objects.get(size=size)
-            Thumbnail.objects.create(image=self, thumbnail_size=thumbnail_size, file_path=thumb_path)
+                def stored_size(height):
+                    width = max(int(height * aspect), 1)
+                    return (height, width) if swapped else (width, height)
 
-            return thumb_path
+                largest = max(thumbnail_sizes)
+                if img.format == "JPEG" and (img.width if swapped else img.height) >= largest * THUMBNAIL_DRAFT_RATIO:
+                    # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the largest target.
+                    img.draft(img.mode, stored_size(largest))
+                # JPEGs are measured after DCT scaling; PNGs can only be decoded whole.
+                memory = decode_memory(img, source_size)
+                if memory_budget is not None and memory > memory_budget:
+                    raise ImageTooLarge(f"Decoding image {self.id} ({img.width}x{img.height} {img.mode}) needs "
+                                        f"{memory} bytes; the budget is {memory_budget}")
+                with timed('pil_decode'):
+                    img.load()
+                source_height = img.width if swapped else img.height
 
+                icc_profile = img.info.get('icc_profile')
+                exif = img.getexif()
+                if ExifTags.Base.Orientation in exif:
+                    # Kept metadata must not turn the upright thumbnail again.
+                    exif[ExifTags.Base.Orientation] = 1
+
+                base = img
+                for size in sorted(thumbnail_sizes, reverse=True):
+                    thumbnail_size = thumbnail_sizes[size]
+                    with timed('pil_resize'):
+                        thumb = base.resize(stored_size(size), reducing_gap=THUMBNAIL_REDUCING_GAP)
+                    if size <= source_height:
+                        base = thumb
+                    if orientation in ORIENTATION_TRANSPOSE:
+                        thumb = thumb.transpose(ORIENTATION_TRANSPOSE[orientation])
+
+                    params = thumbnail_size.encoder_params(file_format)
+                    if thumbnail_size.keep_metadata:
+                        params.update(icc_profile=icc_profile, exif=exif.tobytes() if exif else b'')
+                    else:
+                        # Small thumbnails would otherwise carry a profile of several kilobytes.
+                        thumb = to_srgb(thumb)
+                        params['icc_profile'] = None
+                    paths[size] = store_image(thumb, f"thumbnails/{self.id}_{size}.{file_extension}", file_format,
+                                              **params)
+
+                metadata = {}
+                if not self.phash:
+                    metadata['phash'] = perceptual_hash(thumb)
+                if self.width is None:
+                    # Uploaded before the metadata columns existed.
+                    metadata.update(width=source_size[0], height=source_size[1], format=source_format,
+                                    orientation=orientation, byte_size=self.image_file.size)
+
+            Thumbnail.objects.bulk_create(
+                [Thumbnail(image=self, thumbnail_size=thumbnail_sizes[size], file_path=path, status=Thumbnail.READY)
+                 for size, path in paths.items()],
+                update_conflicts=True,
+                unique_fields=['image', 'thumbnail_size'],
+                update_fields=['file_path', 'status', 'updated_at'],
+            )
+            if metadata:
+                Image.objects.filter(pk=self.pk).update(**metadata)
+                for field, value in metadata.items():
+                    setattr(self, field, value)
+            UserProfile.bump_library_version([self.user_id])
+
+            return paths
+
+        except ImageTooLarge:
+            raise
         except Exception as e:
+            # Thumbnails stored before the failure have no row to refer to them.
+            from .cleanup import delete_unused_files
+            delete_unused_files(thumbnails=paths.values())
             raise ValueError(f"Error creating thumbnail for image {self.id}: {str(e)}")
 
     def __str__(self):
         return f"Image {self.id} by {self.user.username}"
 
 
+@receiver(post_delete, sender=Image)
+def bump_library_version_on_delete(sender, instance, origin=None, **kwargs):
+    # A deleted user takes the profile along; there is no version left to bump.
+    if not isinstance(origin, User):
+        UserProfile.bump_library_version([instance.user_id])
+
+
 class Thumbnail(models.Model):
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
     image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='thumbnails')
     thumbnail_size = models.ForeignKey(ThumbnailSize, on_delete=models.CASCADE, related_name='thumbnails')
-    file_path = models.CharField(max_length=500)
+    file_path = models.CharField(max_length=500, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'thumbnail_size'], name='unique_thumbnail_per_size'),
+        ]
+
+    def create_variant(self, fmt, quality):
+        """Encode this thumbnail in another format next to the original file and record it."""
+        try:
+            with thumbnail_storage().open(self.file_path) as source, PilImage.open(source) as img:
+                if img.mode not in ("RGB", "RGBA"):
+                    has_alpha = img.mode in ("LA", "PA") or "transparency" in img.info
+                    img = img.convert("RGBA" if has_alpha else "RGB")
+                variant_path = store_image(img, f"{os.path.splitext(self.file_path)[0]}.{fmt}", fmt.upper(),
+                                           quality=quality)
+
+            variant, _ = ThumbnailVariant.objects.update_or_create(
+                thumbnail=self, format=fmt, defaults={'file_path': variant_path}
+            )
+            return variant
+
+        except Exception as e:
+            raise ValueError(f"Error creating {fmt} variant of thumbnail {self.id}: {str(e)}")
 
     def __str__(self):
         return f"Thumbnail {self.id} of size {self.thumbnail_size} for Image {self.image.id}"
 
 
+class ThumbnailVariant(models.Model):
+    WEBP = 'webp'
+    AVIF = 'avif'
+    FORMAT_CHOICES = [
+        (WEBP, 'WebP'),
+        (AVIF, 'AVIF'),
+    ]
+
+    thumbnail = models.ForeignKey(Thumbnail, on_delete=models.CASCADE, related_name='variants')
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    file_path = models.CharField(max_length=500)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['thumbnail', 'format'], name='unique_variant_per_format'),
+        ]
+
+    def __str__(self):
+        return f"{self.format} variant of Thumbnail {self.thumbnail_id}"
+
+
+class ThumbnailTask(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    DEFAULT_QUEUE = 'default'
+    LARGE_QUEUE = 'large'
+    QUEUE_CHOICES = [
+        (DEFAULT_QUEUE, 'Default'),
+        (LARGE_QUEUE, 'Large images'),
+    ]
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='thumbnail_tasks')
+    queue = models.CharField(max_length=10, choices=QUEUE_CHOICES, default=DEFAULT_QUEUE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['queue', 'status', 'id'], name='thumbnailtask_queue_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"ThumbnailTask {self.id} for Image {self.image_id} ({self.status})"
+
+
 class ExpiringLink(models.Model):
     image = models.ForeignKey(Image, on_delete=models.CASCADE)
     link = models.CharField(max_length=50, default=secrets.token_urlsafe, unique=True)
 
     expiration_date = models.DateTimeField(null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['expiration_date'], name='expiringlink_expiration_idx'),
+        ]
+
     def is_expired(self):
         return self.expiration_date < timezone.now()
@@ -0,0 +1,87 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class UploadedAtCursorPagination(BasePagination):
+    """
+    Keyset pagination over (uploaded_at, id), newest first.
+
+    Each page starts an index range scan on (user, uploaded_at) at the cursor, so it costs the same however deep
+    the client is in the library.
+    """
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        queryset = queryset.order_by('-uploaded_at', '-id')
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            uploaded_at, pk = cursor
+            # The OR alone is not usable as an index bound; the redundant upper bound on uploaded_at is, and the
+            # OR only breaks ties among rows uploaded at the same instant.
+            queryset = queryset.filter(Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=pk),
+                                       uploaded_at__lte=uploaded_at)
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(last.uploaded_at, last.id))
+
+    def encode_cursor(self, uploaded_at, pk):
+        return base64.urlsafe_b64encode(f"{uploaded_at.isoformat()}|{pk}".encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            uploaded_at, pk = base64.urlsafe_b64decode(encoded.encode()).decode().split('|')
+            uploaded_at = parse_datetime(uploaded_at)
+            pk = int(pk)
+        except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if uploaded_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return uploaded_at, pk
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
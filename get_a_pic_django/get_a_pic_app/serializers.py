@@ -1,12 +1,19 @@
+from django.db import transaction
 from rest_framework import serializers
-from .models import UserProfile, Image, Plan, ThumbnailSize, ExpiringLink
-from PIL import Image as PILImage
+from rest_framework.reverse import reverse
+from .models import UserProfile, Image, Plan, ThumbnailSize, Thumbnail, ExpiringLink
+from .entitlements import get_entitlements
+from .ingest import inspect_image, InvalidImage
+from .metrics import timed
+from .storage import content_version
+from .tasks import enqueue_thumbnails
 
 
 class ThumbnailSizeSerializer(serializers.ModelSerializer):
     class Meta:
         model = ThumbnailSize
-        fields = ('id', 'size')
+        fields = ('id', 'size', 'jpeg_quality', 'jpeg_progressive', 'jpeg_optimize', 'png_compress_level',
+                  'keep_metadata')
 
 
 class PlanSerializer(serializers.ModelSerializer):
@@ -14,27 +21,93 @@ class PlanSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Plan
-        fields = ('id', 'name', 'thumbnail_sizes', 'has_original_image_link', 'can_generate_expiring_link')
+        fields = ('id', 'name', 'thumbnail_sizes', 'has_original_image_link', 'can_generate_expiring_link',
+                  'thumbnail_formats', 'thumbnail_quality')
+
+
+class PlanAssignmentSerializer(serializers.Serializer):
+    users = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        help_text="Ids of the users to move to the plan"
+    )
+    from_plan = serializers.PrimaryKeyRelatedField(
+        queryset=Plan.objects.all(),
+        required=False,
+        help_text="Move every user currently on this plan"
+    )
+
+    def validate(self, attrs):
+        if 'users' not in attrs and 'from_plan' not in attrs:
+            raise serializers.ValidationError("Give 'users', 'from_plan' or both.")
+        return attrs
+
+
+class VersionedImageField(serializers.ImageField):
+    """An ImageField whose URL carries the image's content hash, so that it can be cached as immutable."""
+
+    def to_representation(self, value):
+        url = super().to_representation(value)
+        content_hash = getattr(value.instance, 'content_hash', '')
+        if url and content_hash:
+            url = f"{url}?v={content_hash[:12]}"
+        return url
+
+
+class ImageFilterSerializer(serializers.Serializer):
+    """Query parameters filtering the image list; all of them are served by the metadata columns."""
+    min_width = serializers.IntegerField(min_value=0, required=False)
+    max_width = serializers.IntegerField(min_value=0, required=False)
+    min_height = serializers.IntegerField(min_value=0, required=False)
+    max_height = serializers.IntegerField(min_value=0, required=False)
+    min_byte_size = serializers.IntegerField(min_value=0, required=False)
+    max_byte_size = serializers.IntegerField(min_value=0, required=False)
+    # `format` itself selects the renderer in DRF.
+    image_format = serializers.ChoiceField(choices=['JPEG', 'PNG'], required=False)
+    uploaded_after = serializers.DateTimeField(required=False)
+    uploaded_before = serializers.DateTimeField(required=False)
+
+    lookups = {
+        'min_width': 'width__gte',
+        'max_width': 'width__lte',
+        'min_height': 'height__gte',
+        'max_height': 'height__lte',
+        'min_byte_size': 'byte_size__gte',
+        'max_byte_size': 'byte_size__lte',
+        'image_format': 'format',
+        'uploaded_after': 'uploaded_at__gte',
+        'uploaded_before': 'uploaded_at__lt',
+    }
+
+    def filter(self, queryset):
+        return queryset.filter(**{self.lookups[name]: value for name, value in self.validated_data.items()})
 
 
 class ImageSerializer(serializers.ModelSerializer):
     user = serializers.ReadOnlyField(source='user.username')
-    thumbnail_200 = serializers.SerializerMethodField()
-    thumbnail_400 = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
+    thumbnail_status = serializers.SerializerMethodField()
 
-    image_file = serializers.ImageField(help_text="Only JPG or PNG format allowed")
+    image_file = VersionedImageField(help_text="Only JPG or PNG format allowed")
 
     class Meta:
         model = Image
-        fields = ('id', 'user', 'image_file', 'uploaded_at', 'thumbnail_200', 'thumbnail_400')
+        fields = ('id', 'user', 'image_file', 'uploaded_at', 'width', 'height', 'format', 'byte_size', 'orientation',
+                  'thumbnails', 'thumbnail_status')
+        read_only_fields = ('width', 'height', 'format', 'byte_size', 'orientation')
 
-    def create(self, validated_data):
-        image_instance = super().create(validated_data)
-
-        user_plan = image_instance.user.profile.plan
-        for thumbnail_size in user_plan.thumbnail_sizes.all():
-            image_instance.create_thumbnail(thumbnail_size.size)
+    def get_fields(self):
+        fields = super().get_fields()
+        requested = self.context.get('fields')
+        if requested:
+            fields = {name: field for name, field in fields.items() if name in requested}
+        return fields
 
+    def create(self, validated_data):
+        with transaction.atomic():
+            image_instance = Image.from_upload(validated_data['user'], validated_data['image_file'])
+            image_instance.save()
+            enqueue_thumbnails(image_instance)
         return image_instance
 
     def validate_image_file(self, value):
@@ -42,46 +115,44 @@ class ImageSerializer(serializers.ModelSerializer):
         if file_extension not in ['jpg', 'png']:
             raise serializers.ValidationError("Invalid image format! Only JPG or PNG allowed")
         try:
-            image = PILImage.open(value)
-            image.verify()
-        except Exception:
-            raise serializers.ValidationError("Invalid or corrupted image")
+            value.image_info = inspect_image(value)
+        except InvalidImage as e:
+            raise serializers.ValidationError(str(e))
 
         return value
 
-    def _get_thumbnail_url(self, obj, size):
-        file_extension = obj.image_file.name.split(".")[-1].lower()
-        path = f"/media/thumbnails/{obj.id}_{size}.{file_extension}"
-
-        request = self.context.get('request')
-        base_url = request.build_absolute_uri('/')
-
-        full_url = base_url.rstrip('/') + path
-        return full_url
-
-    def get_thumbnail_200(self, obj):
-        return self._get_thumbnail_url(obj, 200) if self.should_include_thumbnail(obj, 200) else None
-
-    def get_thumbnail_400(self, obj):
-        return self._get_thumbnail_url(obj, 400) if self.should_include_thumbnail(obj, 400) else None
+    def _get_entitlements(self, obj):
+        if 'entitlements' in self.context:
+            return self.context['entitlements']
+        return get_entitlements(obj.user)
 
-    def should_include_thumbnail(self, obj, size):
-        user_plan = obj.user.profile.plan.name
-        if size == 200:
-            return user_plan in ['Basic', 'Premium', 'Enterprise']
-        elif size == 400:
-            return user_plan in ['Premium', 'Enterprise']
-        return False
+    def _get_thumbnail_url(self, obj, size):
+        # Always the endpoint: it serves WebP or AVIF to clients that accept them, and renders missing thumbnails.
+        # Once rendered, the URL carries the thumbnail's content version and is cached as immutable.
+        url = reverse('image-thumbnail', args=[obj.id, size], request=self.context.get('request'))
+        for thumbnail in obj.thumbnails.all():
+            if thumbnail.thumbnail_size.size == size and thumbnail.status == Thumbnail.READY:
+                version = content_version(thumbnail.file_path)
+                return f"{url}?v={version}" if version else url
+        return url
+
+    def get_thumbnails(self, obj):
+        """URLs of every thumbnail size the owner's plan allows, keyed by size."""
+        return {str(thumbnail_size.size): self._get_thumbnail_url(obj, thumbnail_size.size)
+                for thumbnail_size in self._get_entitlements(obj).thumbnail_sizes}
+
+    def get_thumbnail_status(self, obj):
+        return {str(thumbnail.thumbnail_size.size): thumbnail.status for thumbnail in obj.thumbnails.all()}
 
     def should_include_original_link(self, obj):
-        user_plan = obj.user.profile.plan.name
-        return user_plan in ['Premium', 'Enterprise']
+        return self._get_entitlements(obj).has_original_image_link
 
     def to_representation(self, instance):
-        rep = super().to_representation(instance)
+        with timed('serialize'):
+            rep = super().to_representation(instance)
 
-        if not self.should_include_original_link(instance):
-            rep.pop('image_file', None)
+            if not self.should_include_original_link(instance):
+                rep.pop('image_file', None)
 
         return {key: value for key, value in rep.items() if value is not None}
 
@@ -89,11 +160,16 @@ class ImageSerializer(serializers.ModelSerializer):
 class UserProfileSerializer(serializers.ModelSerializer):
     user = serializers.StringRelatedField()
     plan = PlanSerializer(read_only=True)
-    images = ImageSerializer(many=True, read_only=True)
+    images = ImageSerializer(source='user.recent_images', many=True, read_only=True)
+    images_count = serializers.IntegerField(read_only=True)
+    images_url = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfile
-        fields = ('user', 'plan', 'images')
+        fields = ('user', 'plan', 'images', 'images_count', 'images_url')
+
+    def get_images_url(self, obj):
+        return reverse('image-list', request=self.context.get('request'))
 
 
 class ExpiringLinkSerializer(serializers.ModelSerializer):
@@ -105,6 +181,12 @@ class ExpiringLinkSerializer(serializers.ModelSerializer):
         help_text="Set expiration time in seconds (between 300 and 30000)"
     )
     expiration_date = serializers.DateTimeField(read_only=True)
+    mode = serializers.ChoiceField(
+        choices=['db', 'signed'],
+        write_only=True,
+        required=False,
+        help_text="'db' stores the link; 'signed' returns a self-contained signed token (defaults to EXPIRING_LINK_MODE)"
+    )
 
     image = serializers.PrimaryKeyRelatedField(
         queryset=Image.objects.none()
@@ -119,4 +201,4 @@ class ExpiringLinkSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ExpiringLink
-        fields = ['image', 'link', 'expiration_date', 'expiration_seconds']
+        fields = ['image', 'link', 'expiration_date', 'expiration_seconds', 'mode']
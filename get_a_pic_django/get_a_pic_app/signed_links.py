@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core import signing
+
+from .downloads import guess_content_type
+from .link_cache import ResolvedLink
+
+SALT = 'get_a_pic_app.signed-link'
+
+
+def _signer():
+    # A key of its own, so that revoking signed links does not also end every session.
+    return signing.Signer(key=settings.SIGNED_LINK_KEY or settings.SECRET_KEY, salt=SALT,
+                          fallback_keys=settings.SIGNED_LINK_FALLBACK_KEYS)
+
+
+def make_signed_link(image, expiration_seconds):
+    """
+    A token carrying the image id, the stored name of its original and the expiry time, signed with
+    SIGNED_LINK_KEY. Resolving it needs no database row.
+    """
+    payload = {'i': image.pk, 'n': image.image_file.name, 'e': int(time.time()) + expiration_seconds}
+    return _signer().sign_object(payload, compress=True)
+
+
+def resolve_signed_link(token):
+    """Return the ResolvedLink for a signed `token`, or None if it is forged, signed with a revoked key or expired."""
+    try:
+        payload = _signer().unsign_object(token)
+    except signing.BadSignature:
+        return None
+    if payload['e'] <= time.time():
+        return None
+    return ResolvedLink(payload['n'], guess_content_type(payload['n']), payload['e'])
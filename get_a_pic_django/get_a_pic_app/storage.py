@@ -0,0 +1,281 @@
+import hashlib
+import mimetypes
+import mmap
+import os
+import posixpath
+import re
+import secrets
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage, storages
+from django.utils.deconstruct import deconstructible
+
+# Directories holding one file per image or thumbnail, spread over hashed subdirectories.
+DEFAULT_SHARD_PREFIXES = ('thumbnails/', 'uploaded_images/')
+# `file.<12 hex digits>.ext`: the digits are a digest of the file's content.
+CONTENT_VERSION_RE = re.compile(r'\.[0-9a-f]{12}(?=\.[^./]+$)')
+
+
+def versioned_name(name, digest):
+    """Insert the first 12 digits of `digest` before the extension of `name`, replacing any earlier version."""
+    root, extension = posixpath.splitext(CONTENT_VERSION_RE.sub('', name))
+    return f"{root}.{digest[:12]}{extension}"
+
+
+def is_versioned_name(name):
+    """
+    Whether `name` carries a content digest. Such a name never refers to other bytes, so its URL can be cached
+    as immutable.
+    """
+    return CONTENT_VERSION_RE.search(name) is not None
+
+
+def content_version(name):
+    """The 12 digits of content digest in a versioned `name`, or None."""
+    match = CONTENT_VERSION_RE.search(name)
+    return match.group()[1:] if match else None
+
+
+def shard_name(name, prefixes=DEFAULT_SHARD_PREFIXES, depth=2):
+    """
+    Map `dir/file.ext` to `dir/ab/cd/file.ext` when `dir/` is one of `prefixes`; other names are returned as is.
+
+    The shard comes from the file's stem without its content version, so a thumbnail and its format variants land
+    in the same directory.
+    """
+    name = name.replace('\\', '/')
+    directory, filename = posixpath.split(name)
+    if not depth or directory + '/' not in prefixes:
+        return name
+    stem = os.path.splitext(CONTENT_VERSION_RE.sub('', filename))[0]
+    digest = hashlib.md5(stem.encode(), usedforsecurity=False).hexdigest()
+    return posixpath.join(directory, *(digest[index * 2:index * 2 + 2] for index in range(depth)), filename)
+
+
+class ShardedNamesMixin:
+    """
+    Give new files under the shard prefixes a hashed subdirectory, as part of their stored name.
+
+    Names saved before sharding keep working unchanged. With `file_overwrite`, saving an existing name replaces
+    the file instead of picking a new name, which is what re-rendered thumbnails want.
+    """
+    shard_prefixes = DEFAULT_SHARD_PREFIXES
+    shard_depth = 2
+    file_overwrite = False
+
+    def get_available_name(self, name, max_length=None):
+        name = shard_name(name, self.shard_prefixes, self.shard_depth)
+        if self.file_overwrite:
+            return name
+        return super().get_available_name(name, max_length)
+
+
+def thumbnail_storage():
+    return storages['thumbnails']
+
+
+def local_path(storage, name):
+    """The filesystem path of `name`, or None for storages that do not keep files on disk (object stores)."""
+    if isinstance(storage, FileSystemStorage):
+        return storage.path(name)
+    return None
+
+
+def url_lifetime(storage):
+    """Seconds for which `storage.url()` stays valid, or None when its URLs do not expire (unsigned)."""
+    if isinstance(storage, S3Storage) and not storage.custom_domain:
+        return storage.querystring_expire
+    return None
+
+
+@deconstructible(path='get_a_pic_app.storage.ShardedFileSystemStorage')
+class ShardedFileSystemStorage(ShardedNamesMixin, FileSystemStorage):
+    """FileSystemStorage that keeps `thumbnails/` and `uploaded_images/` from growing into one huge directory."""
+
+    def __init__(self, shard_prefixes=DEFAULT_SHARD_PREFIXES, shard_depth=2, file_overwrite=False, **kwargs):
+        super().__init__(**kwargs)
+        self.shard_prefixes = tuple(shard_prefixes)
+        self.shard_depth = shard_depth
+        self.file_overwrite = file_overwrite
+
+    def _save(self, name, content):
+        if not self.file_overwrite:
+            return super()._save(name, content)
+        # Write next to the target and rename over it. Two renders of the same content-versioned name may race;
+        # each rename is atomic, whereas delete-then-create could find the file recreated and never finish.
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+        temporary_path = os.path.join(directory, f".{os.path.basename(full_path)}.{secrets.token_hex(8)}.tmp")
+        try:
+            fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in content.chunks():
+                    file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+            os.replace(temporary_path, full_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return str(name).replace('\\', '/')
+
+
+@deconstructible(path='get_a_pic_app.storage.MmapFileSystemStorage')
+class MmapFileSystemStorage(ShardedFileSystemStorage):
+    """ShardedFileSystemStorage whose read-only opens map the file into memory instead of reading it."""
+
+    def _open(self, name, mode='rb'):
+        if mode not in ('r', 'rb'):
+            return super()._open(name, mode)
+        with open(self.path(name), 'rb') as file:
+            try:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped.
+                return super()._open(name, mode)
+        mapped_file = File(mapped, name)
+        mapped_file.size = len(mapped)
+        return mapped_file
+
+
+@deconstructible(path='get_a_pic_app.storage.S3Storage')
+class S3Storage(ShardedNamesMixin, Storage):
+    """
+    Storage in an S3-compatible bucket, through boto3.
+
+    `endpoint_url` points it at a local stand-in such as MinIO. The client keeps up to `max_pool_connections`
+    connections per process; files above `multipart_threshold` bytes are uploaded in parallel parts.
+
+    Without `file_overwrite` a taken name gets a unique suffix, as on the filesystem: originals must never replace
+    each other. Only the thumbnails storage, whose names carry a digest of their content, should overwrite.
+    """
+
+    def __init__(self, bucket_name=None, location='', endpoint_url=None, region_name=None, access_key=None,
+                 secret_key=None, max_pool_connections=50, multipart_threshold=8 * 1024 * 1024,
+                 multipart_chunksize=8 * 1024 * 1024, max_concurrency=10, querystring_expire=3600,
+                 custom_domain=None, file_overwrite=False, shard_prefixes=DEFAULT_SHARD_PREFIXES, shard_depth=2,
+                 spool_max_size=10 * 1024 * 1024):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise ImproperlyConfigured("S3Storage requires boto3; install it with `pip install boto3`.")
+        if not bucket_name:
+            raise ImproperlyConfigured("S3Storage requires a bucket_name.")
+
+        self.bucket_name = bucket_name
+        self.location = location.strip('/')
+        self.querystring_expire = querystring_expire
+        self.custom_domain = custom_domain
+        self.file_overwrite = file_overwrite
+        self.shard_prefixes = tuple(shard_prefixes)
+        self.shard_depth = shard_depth
+        self.spool_max_size = spool_max_size
+        self.client = boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region_name,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=Config(max_pool_connections=max_pool_connections, retries={'mode': 'standard'}),
+        )
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max_concurrency)
+
+    def _key(self, name):
+        return f"{self.location}/{name}" if self.location else name
+
+    def _is_missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _head(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=self._key(name))
+        except ClientError as error:
+            if self._is_missing(error):
+                raise FileNotFoundError(name)
+            raise
+
+    def _open(self, name, mode='rb'):
+        if mode not in ('r', 'rb'):
+            raise ValueError("S3Storage files can only be opened for reading")
+        from botocore.exceptions import ClientError
+        # PIL and range requests need to seek, so the object is spooled rather than streamed.
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size, dir=settings.FILE_UPLOAD_TEMP_DIR)
+        try:
+            self.client.download_fileobj(self.bucket_name, self._key(name), spool, Config=self.transfer_config)
+        except ClientError as error:
+            spool.close()
+            if self._is_missing(error):
+                raise FileNotFoundError(name)
+            raise
+        spool.seek(0)
+        return File(spool, name)
+
+    def _save(self, name, content):
+        content.seek(0)
+        extra_args = {}
+        content_type = getattr(content, 'content_type', None) or mimetypes.guess_type(name)[0]
+        if content_type:
+            extra_args['ContentType'] = content_type
+        if is_versioned_name(name):
+            extra_args['CacheControl'] = f"public, max-age={settings.MEDIA_IMMUTABLE_MAX_AGE}, immutable"
+        self.client.upload_fileobj(content, self.bucket_name, self._key(name), ExtraArgs=extra_args,
+                                   Config=self.transfer_config)
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket_name, Key=self._key(name))
+
+    def exists(self, name):
+        try:
+            self._head(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, name):
+        return self._head(name)['ContentLength']
+
+    def get_modified_time(self, name):
+        return self._head(name)['LastModified']
+
+    def listdir(self, path):
+        prefix = self._key(path.rstrip('/') + '/') if path else (f"{self.location}/" if self.location else '')
+        directories, files = [], []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix,
+                                                                           Delimiter='/'):
+            directories += [entry['Prefix'][len(prefix):].rstrip('/') for entry in page.get('CommonPrefixes', [])]
+            files += [entry['Key'][len(prefix):] for entry in page.get('Contents', [])]
+        return directories, files
+
+    def iter_files(self, path):
+        """Yield the names of all files under `path`, one listing page (up to 1000 keys) at a time."""
+        prefix = self._key(path.rstrip('/') + '/') if path else (f"{self.location}/" if self.location else '')
+        strip = len(f"{self.location}/") if self.location else 0
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for entry in page.get('Contents', []):
+                yield entry['Key'][strip:]
+
+    def url(self, name):
+        key = self._key(name)
+        if self.custom_domain:
+            return f"https://{self.custom_domain}/{key}"
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket_name, 'Key': key},
+                                                  ExpiresIn=self.querystring_expire)
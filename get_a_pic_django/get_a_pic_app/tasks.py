@@ -0,0 +1,409 @@
+import logging
+import multiprocessing
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .entitlements import get_entitlements, get_plan_entitlements, invalidate_on_commit, invalidate_user
+from .metrics import expired_links_purged_total, large_images_deferred_total, timed
+from .models import ExpiringLink, Image, ImageTooLarge, Thumbnail, ThumbnailTask, UserProfile
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLocks:
+    """One lock per key, dropped once nobody holds or waits on it."""
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+render_locks = KeyedLocks()
+
+
+def _reusable_thumbnails(images, sizes):
+    """
+    Map (content hash, size id) -> file path of thumbnails already rendered for identical originals.
+
+    The thumbnails are locked until the transaction commits, so a concurrent delete cannot remove their files
+    before the rows reusing them are visible.
+    """
+    hashes = {image.content_hash for image in images if image.content_hash}
+    if not hashes:
+        return {}
+    # Model instances, not values_list(): OF is only applied to them, and without it the images are locked too.
+    thumbnails = Thumbnail.objects.select_for_update(of=('self',)) \
+        .filter(image__content_hash__in=hashes, status=Thumbnail.READY, thumbnail_size__in=sizes) \
+        .exclude(image__in=images).select_related('image').only('thumbnail_size_id', 'file_path', 'image__content_hash')
+    return {(thumbnail.image.content_hash, thumbnail.thumbnail_size_id): thumbnail.file_path
+            for thumbnail in thumbnails}
+
+
+def enqueue_thumbnails(image, sizes=None):
+    """Create Thumbnail rows for `sizes` (defaults to the owner's plan) and queue a render task."""
+    if sizes is None:
+        sizes = list(get_entitlements(image.user).thumbnail_sizes)
+    tasks = enqueue_thumbnails_bulk([image], sizes)
+    return tasks[0] if tasks else None
+
+
+@transaction.atomic
+def enqueue_thumbnails_bulk(images, sizes):
+    """
+    Create Thumbnail rows for every image and size, and queue one render task per image that needs one.
+
+    Sizes already rendered for the same content are reused as-is, so only the rest need rendering.
+    The number of queries does not depend on how many images are passed.
+    """
+    if not images or not sizes:
+        return []
+
+    reusable = _reusable_thumbnails(images, sizes)
+    thumbnails = []
+    for image in images:
+        for size in sizes:
+            file_path = reusable.get((image.content_hash, size.id))
+            if file_path is not None:
+                thumbnails.append(Thumbnail(image=image, thumbnail_size=size, file_path=file_path,
+                                            status=Thumbnail.READY))
+            else:
+                thumbnails.append(Thumbnail(image=image, thumbnail_size=size, status=Thumbnail.PENDING))
+    Thumbnail.objects.bulk_create(thumbnails, ignore_conflicts=True)
+    Thumbnail.objects.filter(image__in=images, thumbnail_size__in=sizes, status=Thumbnail.FAILED) \
+        .update(status=Thumbnail.PENDING, updated_at=timezone.now())
+
+    UserProfile.bump_library_version({image.user_id for image in images})
+
+    pending = set(Thumbnail.objects.filter(image__in=images, status=Thumbnail.PENDING)
+                  .values_list('image_id', flat=True))
+    tasks = ThumbnailTask.objects.bulk_create([ThumbnailTask(image=image) for image in images if image.id in pending])
+    if settings.THUMBNAIL_TASKS_EAGER and tasks:
+        task_ids = [task.id for task in tasks]
+        # This runs in the request's thread: forking a pool there (and closing its connections) is not safe.
+        transaction.on_commit(lambda: process_tasks(task_ids, processes=1))
+    return tasks
+
+
+def enqueue_missing_thumbnails(images):
+    """
+    Queue, for each of `images` (a queryset), the sizes of its owner's plan that it has no ready thumbnail of.
+
+    Images missing the same sizes are queued together; returns the created tasks.
+    """
+    images = list(images.annotate(owner_plan_id=F('user__profile__plan_id')))
+    ready = set(Thumbnail.objects.filter(image__in=images, status=Thumbnail.READY)
+                .values_list('image_id', 'thumbnail_size_id'))
+    by_missing_sizes = defaultdict(list)
+    for image in images:
+        missing = tuple(size for size in get_plan_entitlements(image.owner_plan_id).thumbnail_sizes
+                        if (image.id, size.id) not in ready)
+        if missing:
+            by_missing_sizes[missing].append(image)
+    tasks = []
+    for sizes, group in by_missing_sizes.items():
+        tasks.extend(enqueue_thumbnails_bulk(group, list(sizes)))
+    return tasks
+
+
+def change_plan(user_ids, plan, batch_size=None):
+    """
+    Move the users with `user_ids` to `plan` (None for no plan), `batch_size` users per transaction.
+
+    Each batch updates the profiles with one query, deletes the thumbnails of sizes the new plan lacks and queues
+    only the sizes the users' images are missing. Returns (users moved, thumbnails removed, render tasks queued).
+    """
+    batch_size = batch_size or settings.PLAN_CHANGE_BATCH_SIZE
+    user_ids = sorted(set(user_ids))
+    sizes = get_plan_entitlements(plan.id if plan is not None else None).thumbnail_sizes
+    moved = removed = queued = 0
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        with transaction.atomic():
+            moved += UserProfile.objects.filter(user_id__in=batch).update(plan=plan)
+            # update() sends no post_save, so the cached plan ids are evicted here, and again once the batch
+            # commits: requests in between still read the old plan and would cache it.
+            invalidate_on_commit(invalidate_user, batch)
+
+            # Their files go once the batch commits, unless identical images still share them.
+            dropped = Thumbnail.objects.filter(image__user_id__in=batch).exclude(thumbnail_size__in=sizes)
+            removed += dropped.delete()[1].get(Thumbnail._meta.label, 0)
+            UserProfile.bump_library_version(batch)
+
+            images = Image.objects.filter(user_id__in=batch).order_by('id')
+            last_id = 0
+            while True:
+                chunk = list(images.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+                if not chunk:
+                    break
+                queued += len(enqueue_missing_thumbnails(Image.objects.filter(id__in=chunk)))
+                last_id = chunk[-1]
+    return moved, removed, queued
+
+
+def memory_budget(queue):
+    """The decode memory budget of workers on `queue`, in bytes; None for no limit."""
+    if queue == ThumbnailTask.LARGE_QUEUE:
+        return settings.THUMBNAIL_LARGE_MEMORY_BUDGET
+    return settings.THUMBNAIL_MEMORY_BUDGET
+
+
+def defer_to_large_queue(image):
+    """Queue `image` for the large-image workers, unless it is queued there already."""
+    large_images_deferred_total.inc()
+    if not ThumbnailTask.objects.filter(image=image, queue=ThumbnailTask.LARGE_QUEUE,
+                                        status__in=[ThumbnailTask.QUEUED, ThumbnailTask.RUNNING]).exists():
+        ThumbnailTask.objects.create(image=image, queue=ThumbnailTask.LARGE_QUEUE)
+
+
+def claim_task(queue=ThumbnailTask.DEFAULT_QUEUE):
+    with transaction.atomic():
+        task = ThumbnailTask.objects.select_for_update(skip_locked=True) \
+            .filter(queue=queue, status=ThumbnailTask.QUEUED).order_by('id').first()
+        if task is None:
+            return None
+        task.status = ThumbnailTask.RUNNING
+        task.attempts += 1
+        task.save(update_fields=['status', 'attempts', 'updated_at'])
+    return task
+
+
+def claim_task_by_id(task_id):
+    claimed = ThumbnailTask.objects.filter(pk=task_id, status=ThumbnailTask.QUEUED) \
+        .update(status=ThumbnailTask.RUNNING, attempts=F('attempts') + 1, updated_at=timezone.now())
+    return ThumbnailTask.objects.get(pk=task_id) if claimed else None
+
+
+def _process_task_id(task_id):
+    task = claim_task_by_id(task_id)
+    return process_task(task) if task is not None else False
+
+
+def process_tasks(task_ids, processes=None):
+    """
+    Render the given tasks right away, across a process pool when there is more than one.
+
+    The pool forks the calling process, so only single-threaded commands should ask for one; eager mode renders
+    inline.
+    """
+    processes = min(processes or settings.THUMBNAIL_WORKER_PROCESSES, len(task_ids))
+    if processes <= 1:
+        return [_process_task_id(task_id) for task_id in task_ids]
+
+    # Forked children must not share the parent's database connections.
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+        return list(pool.map(_process_task_id, task_ids))
+
+
+@contextmanager
+def heartbeat(task, interval=None):
+    """Touch `task` every `interval` seconds while the block runs, so a long render is not taken for a dead one."""
+    interval = interval or settings.THUMBNAIL_TASK_HEARTBEAT
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                ThumbnailTask.objects.filter(pk=task.pk, status=ThumbnailTask.RUNNING) \
+                    .update(updated_at=timezone.now())
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f"heartbeat-{task.pk}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def process_task(task):
+    image = task.image
+    pending = image.thumbnails.filter(status=Thumbnail.PENDING).select_related('thumbnail_size')
+    try:
+        sizes = [thumbnail.thumbnail_size for thumbnail in pending]
+        if sizes:
+            with heartbeat(task):
+                image.create_thumbnails(sizes, memory_budget=memory_budget(task.queue))
+    except ImageTooLarge as e:
+        if task.queue == ThumbnailTask.LARGE_QUEUE:
+            # Over even the large-image budget; retrying cannot help.
+            return _fail_task(task, e, retry=False)
+        # Not counted as an attempt: the task only moves to the large-image workers.
+        logger.info("Thumbnail task %s moved to the large-image queue: %s", task.id, e)
+        large_images_deferred_total.inc()
+        task.queue = ThumbnailTask.LARGE_QUEUE
+        task.status = ThumbnailTask.QUEUED
+        task.attempts -= 1
+        task.save(update_fields=['queue', 'status', 'attempts', 'updated_at'])
+        return False
+    except Exception as e:
+        return _fail_task(task, e)
+
+    task.status = ThumbnailTask.DONE
+    task.save(update_fields=['status', 'updated_at'])
+    return True
+
+
+def _fail_task(task, e, retry=True):
+    logger.exception("Thumbnail task %s failed", task.id)
+    task.last_error = str(e)
+    if retry and task.attempts < settings.THUMBNAIL_TASK_MAX_ATTEMPTS:
+        task.status = ThumbnailTask.QUEUED
+    else:
+        task.status = ThumbnailTask.FAILED
+        task.image.thumbnails.filter(status=Thumbnail.PENDING).update(status=Thumbnail.FAILED,
+                                                                       updated_at=timezone.now())
+        UserProfile.bump_library_version([task.image.user_id])
+    task.save(update_fields=['status', 'last_error', 'updated_at'])
+    return False
+
+
+def requeue_stale_tasks(timeout=None):
+    """
+    Put back tasks whose worker died mid-render, i.e. sent no heartbeat for `timeout` seconds; returns how many.
+
+    Tasks that have had THUMBNAIL_TASK_MAX_ATTEMPTS attempts are failed with their pending thumbnails instead: a
+    render that gets its worker killed, e.g. for running out of memory, would otherwise be retried forever.
+    """
+    timeout = timeout or settings.THUMBNAIL_TASK_TIMEOUT
+    now = timezone.now()
+    stale = ThumbnailTask.objects.filter(status=ThumbnailTask.RUNNING, updated_at__lt=now - timedelta(seconds=timeout))
+    with transaction.atomic():
+        exhausted = list(stale.filter(attempts__gte=settings.THUMBNAIL_TASK_MAX_ATTEMPTS).select_for_update()
+                         .values_list('id', 'image_id', 'image__user_id'))
+        if exhausted:
+            task_ids, image_ids, user_ids = zip(*exhausted)
+            logger.error("Thumbnail tasks %s lost their worker %d times; giving up", list(task_ids),
+                         settings.THUMBNAIL_TASK_MAX_ATTEMPTS)
+            ThumbnailTask.objects.filter(pk__in=task_ids).update(
+                status=ThumbnailTask.FAILED, last_error="The worker stopped before finishing", updated_at=now)
+            Thumbnail.objects.filter(image_id__in=image_ids, status=Thumbnail.PENDING) \
+                .update(status=Thumbnail.FAILED, updated_at=now)
+            UserProfile.bump_library_version(set(user_ids))
+        return stale.update(status=ThumbnailTask.QUEUED)
+
+
+def purge_expired_links(batch_size=None, pause=0.0, max_batches=None):
+    """
+    Delete expired links (and links without an expiration date) in batches; return the number deleted.
+
+    Each batch is its own short transaction that deletes at most `batch_size` rows found through the
+    expiration_date index, so the purge never holds long locks on the table.
+    """
+    batch_size = batch_size or settings.EXPIRING_LINK_PURGE_BATCH_SIZE
+    cutoff = timezone.now()
+    expired = ExpiringLink.objects.filter(Q(expiration_date__lte=cutoff) | Q(expiration_date__isnull=True))
+    purged = batches = 0
+    with timed('purge_expired_links'):
+        while max_batches is None or batches < max_batches:
+            ids = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            deleted, _ = ExpiringLink.objects.filter(pk__in=ids).delete()
+            expired_links_purged_total.inc(deleted)
+            purged += deleted
+            batches += 1
+            if pause and len(ids) == batch_size:
+                time.sleep(pause)
+    return purged
+
+
+def run_worker(once=False, poll_interval=1.0, queue=ThumbnailTask.DEFAULT_QUEUE):
+    """Process tasks queued on `queue` until it is empty (`once`) or forever."""
+    processed = 0
+    while True:
+        task = claim_task(queue)
+        if task is None:
+            if once:
+                return processed
+            requeue_stale_tasks()
+            time.sleep(poll_interval)
+            continue
+        process_task(task)
+        processed += 1
+
+
+def run_worker_pool(processes, once=False, poll_interval=1.0, queue=ThumbnailTask.DEFAULT_QUEUE):
+    if processes <= 1:
+        return run_worker(once=once, poll_interval=poll_interval, queue=queue)
+
+    # Forked children must not share the parent's database connections.
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=run_worker, kwargs={'once': once, 'poll_interval': poll_interval, 'queue': queue})
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def get_or_render_thumbnail(image, thumbnail_size):
+    """
+    Return the ready Thumbnail of `image` in `thumbnail_size`, rendering and storing it first if needed.
+
+    Concurrent first requests collapse into one render: threads wait on a per-thumbnail lock, and other
+    processes wait on the row lock taken with SELECT ... FOR UPDATE.
+
+    Originals over THUMBNAIL_MEMORY_BUDGET are not rendered inline but queued for the large-image workers; the
+    returned thumbnail is then still pending.
+    """
+    thumbnail = Thumbnail.objects.filter(image=image, thumbnail_size=thumbnail_size, status=Thumbnail.READY).first()
+    if thumbnail is not None:
+        return thumbnail
+
+    with render_locks.hold((image.id, thumbnail_size.id)), transaction.atomic():
+        thumbnail, _ = Thumbnail.objects.get_or_create(image=image, thumbnail_size=thumbnail_size)
+        thumbnail = Thumbnail.objects.select_for_update().get(pk=thumbnail.pk)
+        if thumbnail.status != Thumbnail.READY:
+            try:
+                image.create_thumbnails([thumbnail_size], memory_budget=settings.THUMBNAIL_MEMORY_BUDGET)
+            except ImageTooLarge:
+                if thumbnail.status != Thumbnail.PENDING:
+                    thumbnail.status = Thumbnail.PENDING
+                    thumbnail.save(update_fields=['status', 'updated_at'])
+                UserProfile.bump_library_version([image.user_id])
+                defer_to_large_queue(image)
+                return thumbnail
+            thumbnail.refresh_from_db()
+    return thumbnail
+
+
+def get_or_render_variant(thumbnail, fmt, quality):
+    """Return the ThumbnailVariant of `thumbnail` in `fmt`, encoding it once on first use."""
+    variant = thumbnail.variants.filter(format=fmt).first()
+    if variant is not None:
+        return variant
+
+    with render_locks.hold((thumbnail.id, fmt)):
+        variant = thumbnail.variants.filter(format=fmt).first()
+        if variant is None:
+            variant = thumbnail.create_variant(fmt, quality)
+    return variant
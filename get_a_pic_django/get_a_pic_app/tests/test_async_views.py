@@ -0,0 +1,114 @@
+import asyncio
+import os
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from ..link_cache import local_cache
+from ..models import ExpiringLink, Image, Plan, Thumbnail, ThumbnailSize, User
+from ..signed_links import make_signed_link
+
+
+async def _body(response):
+    return b''.join([chunk async for chunk in response.streaming_content])
+
+
+class AsyncDeliveryTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.size_200 = ThumbnailSize.objects.create(size=200)
+        plan = Plan.objects.create(name='Premium', has_original_image_link=True)
+        plan.thumbnail_sizes.add(self.size_200)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+        self.async_client.force_login(self.user)
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            self.image_content = img_file.read()
+        image_file = SimpleUploadedFile(name='test_image.jpg', content=self.image_content, content_type='image/jpeg')
+        self.image = Image.objects.create(user=self.user, image_file=image_file)
+        self.link = ExpiringLink.objects.create(image=self.image,
+                                                expiration_date=timezone.now() + timedelta(seconds=300))
+
+    async def test_retrieve_by_token_streams_file(self):
+        url = reverse('async-expiringlink-retrieve-by-token', args=[self.link.link])
+
+        response = await self.async_client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.image_content)))
+        self.assertEqual(await _body(response), self.image_content)
+
+    async def test_retrieve_by_token_range(self):
+        url = reverse('async-expiringlink-retrieve-by-token', args=[self.link.link])
+
+        response = await self.async_client.get(url, headers={'Range': 'bytes=10-19'})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(await _body(response), self.image_content[10:20])
+
+    async def test_retrieve_by_token_requires_authentication(self):
+        self.async_client.cookies.clear()
+
+        response = await self.async_client.get(reverse('async-expiringlink-retrieve-by-token', args=[self.link.link]))
+
+        self.assertEqual(response.status_code, 403)
+
+    async def test_unknown_token(self):
+        response = await self.async_client.get(reverse('async-expiringlink-retrieve-by-token', args=['missing']))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_retrieve_signed(self):
+        url = reverse('async-expiringlink-retrieve-signed', args=[make_signed_link(self.image, 300)])
+
+        response = await self.async_client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await _body(response), self.image_content)
+
+    async def test_concurrent_downloads(self):
+        url = reverse('async-expiringlink-retrieve-by-token', args=[self.link.link])
+
+        responses = await asyncio.gather(*(self.async_client.get(url) for _ in range(20)))
+        bodies = await asyncio.gather(*(_body(response) for response in responses))
+
+        self.assertTrue(all(body == self.image_content for body in bodies))
+
+    async def test_thumbnail_is_rendered_and_streamed(self):
+        response = await self.async_client.get(reverse('async-image-thumbnail', args=[self.image.id, 200]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(await _body(response))
+        thumbnail = await Thumbnail.objects.aget(image=self.image, thumbnail_size=self.size_200)
+        self.assertEqual(thumbnail.status, Thumbnail.READY)
+
+    async def test_thumbnail_size_outside_plan(self):
+        response = await self.async_client.get(reverse('async-image-thumbnail', args=[self.image.id, 400]))
+        self.assertEqual(response.status_code, 403)
+
+    async def test_original(self):
+        response = await self.async_client.get(reverse('async-image-original', args=[self.image.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await _body(response), self.image_content)
+
+    async def test_other_users_image_is_not_found(self):
+        other = await User.objects.acreate(username='other')
+        image = await Image.objects.acreate(user=other, image_file=self.image.image_file.name)
+
+        response = await self.async_client.get(reverse('async-image-original', args=[image.id]))
+
+        self.assertEqual(response.status_code, 404)
+
+    async def test_requires_authentication(self):
+        self.async_client.cookies.clear()
+        response = await self.async_client.get(reverse('async-image-original', args=[self.image.id]))
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,202 @@
+import json
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import InMemoryStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from ..cleanup import walk_storage
+from ..metrics import expired_links_purged_total
+from ..models import ExpiringLink, Image, Plan, Thumbnail, ThumbnailSize, ThumbnailTask, User
+from ..storage import thumbnail_storage
+
+
+class BenchmarkCommandTestCase(TestCase):
+
+    def test_benchmark_writes_json_results(self):
+        plan = Plan.objects.create(name='Basic')
+        plan.thumbnail_sizes.add(ThumbnailSize.objects.create(size=400))
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'bench.json')
+            call_command('benchmark', '--use-current-db', '--megapixels=1', '--formats=jpeg,png',
+                         '--library-sizes=1,3', '--upload-megapixels=1', '--repeat=1', f'--output={output}', stderr=open(os.devnull, 'w'))
+            call_command('benchmark', '--use-current-db', '--megapixels=1', '--formats=jpeg',
+                         '--library-sizes=1', '--upload-megapixels=1', '--repeat=1', f'--compare={output}',
+                         stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+
+            with open(output) as file:
+                report = json.load(file)
+
+        names = [result['name'] for result in report['results']]
+        self.assertEqual(names.count('create_thumbnails'), 2)
+        self.assertEqual(names.count('image_list'), 2)
+        self.assertEqual(names.count('upload'), 3)
+        self.assertEqual(names.count('retrieve_by_token'), 1)
+        list_results = [result for result in report['results'] if result['name'] == 'image_list']
+        self.assertEqual(list_results[0]['queries'], list_results[1]['queries'])
+        self.assertEqual(report['meta']['database'], 'sqlite')
+        # The current database is left as it was found.
+        self.assertEqual(list(Plan.objects.all()), [plan])
+        self.assertEqual([size.size for size in plan.thumbnail_sizes.all()], [400])
+        self.assertEqual(list(ThumbnailSize.objects.values_list('size', flat=True)), [400])
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Image.objects.exists())
+
+
+class PurgeExpiredLinksCommandTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user(username='testuser', password='testpassword')
+        image_file = SimpleUploadedFile(name='test_image.jpg', content=b'jpeg', content_type='image/jpeg')
+        self.image = Image.objects.create(user=user, image_file=image_file)
+        now = timezone.now()
+        ExpiringLink.objects.bulk_create([
+            ExpiringLink(image=self.image, link=f'expired-{index}', expiration_date=now - timedelta(seconds=index + 1))
+            for index in range(5)
+        ])
+        self.live = ExpiringLink.objects.create(image=self.image, expiration_date=now + timedelta(seconds=300))
+
+    def test_purges_expired_links_in_batches(self):
+        purged_before = expired_links_purged_total.value()
+        stdout = StringIO()
+
+        call_command('purge_expired_links', '--batch-size=2', stdout=stdout)
+
+        self.assertEqual(list(ExpiringLink.objects.all()), [self.live])
+        self.assertIn("Purged 5 expired link(s)", stdout.getvalue())
+        self.assertEqual(expired_links_purged_total.value() - purged_before, 5)
+
+    def test_max_batches(self):
+        call_command('purge_expired_links', '--batch-size=2', '--max-batches=1', stdout=StringIO())
+        self.assertEqual(ExpiringLink.objects.count(), 4)
+
+    def test_metrics_file_accumulates_across_runs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'purge.prom')
+
+            call_command('purge_expired_links', '--batch-size=2', '--max-batches=1', f'--metrics-file={path}',
+                         stdout=StringIO())
+            call_command('purge_expired_links', f'--metrics-file={path}', stdout=StringIO())
+
+            with open(path) as file:
+                lines = file.read().splitlines()
+            self.assertIn('# TYPE getapic_expired_links_purged_total counter', lines)
+            self.assertIn('getapic_expired_links_purged_total 5', lines)
+            self.assertEqual(os.listdir(directory), ['purge.prom'])
+
+
+class BackfillThumbnailsCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.size_200 = ThumbnailSize.objects.create(size=200)
+        self.size_400 = ThumbnailSize.objects.create(size=400)
+        plan = Plan.objects.create(name='Premium')
+        plan.thumbnail_sizes.add(self.size_200, self.size_400)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg'), 'rb') as file:
+            content = file.read()
+        self.images = [
+            Image.objects.create(user=self.user, image_file=SimpleUploadedFile(name='test_image.jpg', content=content))
+            for _ in range(3)
+        ]
+        self.images[0].create_thumbnails([200])
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.directory.name, 'backfill.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _backfill(self, *args):
+        stdout = StringIO()
+        call_command('backfill_thumbnails', '--processes=1', '--batch-size=2', f'--checkpoint={self.checkpoint}',
+                     *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_renders_missing_sizes(self):
+        output = self._backfill()
+
+        self.assertEqual(Thumbnail.objects.filter(status=Thumbnail.READY).count(), 6)
+        self.assertIn("Done: 3 images scanned", output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_resumes_from_checkpoint(self):
+        with open(self.checkpoint, 'w') as file:
+            json.dump({'plan': None, 'last_image_id': self.images[1].id, 'images': 2, 'queued': 2, 'failed': 0}, file)
+
+        output = self._backfill()
+
+        self.assertIn(f"Resuming after image {self.images[1].id}", output)
+        self.assertEqual(self.images[2].thumbnails.filter(status=Thumbnail.READY).count(), 2)
+        self.assertFalse(self.images[1].thumbnails.exists())
+
+    def test_enqueue_only(self):
+        self._backfill('--enqueue-only')
+
+        # Identical originals reuse the rendered 200px thumbnail; the rest waits for the workers.
+        self.assertTrue(ThumbnailTask.objects.filter(status=ThumbnailTask.QUEUED).exists())
+        self.assertEqual(Thumbnail.objects.filter(status=Thumbnail.PENDING).count(), 3)
+        self.assertEqual(Thumbnail.objects.filter(status=Thumbnail.READY).count(), 3)
+
+
+class ReconcileStorageCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        media_root = override_settings(MEDIA_ROOT=self.directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.addCleanup(self.directory.cleanup)
+
+        ThumbnailSize.objects.create(size=200)
+        user = User.objects.create_user(username='testuser', password='testpassword')
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg'), 'rb') as file:
+            image_file = SimpleUploadedFile(name='test_image.jpg', content=file.read())
+        self.image = Image.objects.create(user=user, image_file=image_file)
+        self.thumbnail = self.image.create_thumbnail(200)
+        self.orphans = [
+            default_storage.save('uploaded_images/orphan.jpg', ContentFile(b'jpeg')),
+            thumbnail_storage().save('thumbnails/999_200.0123456789ab.jpg', ContentFile(b'jpeg')),
+        ]
+
+    def _reconcile(self, *args):
+        stdout = StringIO()
+        call_command('reconcile_storage', '--batch-size=1', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_walk_storage(self):
+        self.assertEqual(set(walk_storage(default_storage, 'uploaded_images')),
+                         {self.image.image_file.name, self.orphans[0]})
+        self.assertEqual(list(walk_storage(default_storage, 'missing')), [])
+
+        storage = InMemoryStorage()
+        names = {storage.save(name, ContentFile(b'jpeg')) for name in ('thumbnails/a/1.jpg', 'thumbnails/2.jpg')}
+        self.assertEqual(set(walk_storage(storage, 'thumbnails')), names)
+
+    def test_deletes_orphans_only(self):
+        output = self._reconcile('--min-age=0')
+
+        self.assertIn("Scanned 4 file(s): 2 orphan(s), 0 too recent to delete, 2 deleted", output)
+        self.assertFalse(any(default_storage.exists(name) for name in self.orphans))
+        self.assertTrue(default_storage.exists(self.image.image_file.name))
+        self.assertTrue(thumbnail_storage().exists(self.thumbnail))
+
+    def test_keeps_recent_orphans(self):
+        output = self._reconcile()
+
+        self.assertIn("2 too recent to delete, 0 deleted", output)
+        self.assertTrue(all(default_storage.exists(name) for name in self.orphans))
+
+    def test_dry_run(self):
+        output = self._reconcile('--min-age=0', '--dry-run')
+
+        self.assertIn("2 orphan(s), 0 too recent to delete, 0 deleted", output)
+        self.assertTrue(all(default_storage.exists(name) for name in self.orphans))
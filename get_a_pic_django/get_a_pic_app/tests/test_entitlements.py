@@ -0,0 +1,103 @@
+import os
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from ..entitlements import USER_KEY_PREFIX, get_entitlements, local_cache
+from ..models import Image, Plan, ThumbnailSize, User
+
+
+class EntitlementsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.size_200 = ThumbnailSize.objects.create(size=200)
+        self.size_640 = ThumbnailSize.objects.create(size=640)
+        self.plan = Plan.objects.create(name='Custom')
+        self.plan.thumbnail_sizes.add(self.size_640)
+        self.user.profile.plan = self.plan
+        self.user.profile.save()
+
+    def test_compiled_from_plan_rows(self):
+        entitlements = get_entitlements(self.user)
+
+        self.assertEqual(entitlements.plan_name, 'Custom')
+        self.assertEqual([size.size for size in entitlements.thumbnail_sizes], [640])
+        self.assertFalse(entitlements.has_original_image_link)
+        self.assertEqual(entitlements.get_thumbnail_size(640), self.size_640)
+        self.assertIsNone(entitlements.get_thumbnail_size(200))
+
+    def test_cached_entitlements_need_no_queries(self):
+        get_entitlements(self.user)
+        with self.assertNumQueries(0):
+            get_entitlements(self.user)
+
+    def test_plan_edit_invalidates(self):
+        get_entitlements(self.user)
+
+        self.plan.has_original_image_link = True
+        self.plan.save()
+        self.plan.thumbnail_sizes.add(self.size_200)
+
+        entitlements = get_entitlements(self.user)
+        self.assertTrue(entitlements.has_original_image_link)
+        self.assertEqual([size.size for size in entitlements.thumbnail_sizes], [200, 640])
+
+    def test_size_removed_from_reverse_side_invalidates(self):
+        get_entitlements(self.user)
+        self.size_640.plan_set.remove(self.plan)
+        self.assertEqual(get_entitlements(self.user).thumbnail_sizes, ())
+
+    def test_plan_change_invalidates(self):
+        get_entitlements(self.user)
+        other_plan = Plan.objects.create(name='Other', can_generate_expiring_link=True)
+
+        self.user.profile.plan = other_plan
+        self.user.profile.save()
+
+        self.assertTrue(get_entitlements(self.user).can_generate_expiring_link)
+
+    def test_plan_change_invalidates_again_on_commit(self):
+        other_plan = Plan.objects.create(name='Other', can_generate_expiring_link=True)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.plan = other_plan
+            self.user.profile.save()
+            # A concurrent request reads the still-committed old plan and caches it.
+            cache.set(USER_KEY_PREFIX + str(self.user.id), self.plan.id)
+            local_cache.set(USER_KEY_PREFIX + str(self.user.id), self.plan.id, 60)
+
+        self.assertTrue(get_entitlements(self.user).can_generate_expiring_link)
+
+    def test_user_without_plan(self):
+        self.user.profile.plan = None
+        self.user.profile.save()
+        entitlements = get_entitlements(self.user)
+        self.assertEqual(entitlements.thumbnail_sizes, ())
+        self.assertFalse(entitlements.can_generate_expiring_link)
+
+    def test_serializer_lists_admin_defined_sizes(self):
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            image_file = SimpleUploadedFile(name='test_image.jpg', content=img_file.read(), content_type='image/jpeg')
+        image = Image.objects.create(user=self.user, image_file=image_file)
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        response = client.get(reverse('image-detail', args=[image.id]))
+
+        self.assertEqual(list(response.data['thumbnails']), ['640'])
+        self.assertNotIn('image_file', response.data)
+
+    def test_expiring_links_follow_plan_flag(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        url = reverse('expiringlink-list')
+
+        self.assertEqual(client.post(url, {}).status_code, 403)
+
+        self.plan.can_generate_expiring_link = True
+        self.plan.save()
+        self.assertEqual(client.post(url, {}).status_code, 400)
@@ -0,0 +1,152 @@
+import hashlib
+import io
+import os
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image as PilImage
+from rest_framework.test import APIClient
+from ..ingest import content_hash, inspect_image, InvalidImage, perceptual_hash
+from ..models import Image, Plan, Thumbnail, ThumbnailSize, ThumbnailTask, User
+from ..storage import thumbnail_storage
+
+
+def make_upload(name, size=(30, 20), image_format='JPEG', color='blue', **params):
+    buffer = io.BytesIO()
+    PilImage.new('RGB', size, color).save(buffer, image_format, **params)
+    return SimpleUploadedFile(name=name, content=buffer.getvalue())
+
+
+def hamming_distance(first, second):
+    return bin(int(first, 16) ^ int(second, 16)).count('1')
+
+
+class InspectImageTestCase(TestCase):
+
+    def test_reads_format_and_dimensions(self):
+        info = inspect_image(make_upload('image.png', image_format='PNG'))
+        self.assertEqual(info, ('PNG', 30, 20, 1))
+
+    def test_reads_exif_orientation(self):
+        exif = PilImage.Exif()
+        exif[0x0112] = 6
+        info = inspect_image(make_upload('image.jpg', exif=exif.tobytes()))
+        self.assertEqual(info.orientation, 6)
+
+    def test_perceptual_hash_matches_resized_copies(self):
+        img = PilImage.linear_gradient('L').rotate(90).resize((300, 200)).convert('RGB')
+
+        original = perceptual_hash(img)
+
+        self.assertLessEqual(hamming_distance(original, perceptual_hash(img.resize((90, 60)))), 4)
+        self.assertGreater(hamming_distance(original, perceptual_hash(img.transpose(PilImage.Transpose.FLIP_LEFT_RIGHT))), 32)
+
+    @override_settings(IMAGE_MAX_PIXELS=599)
+    def test_rejects_too_many_pixels(self):
+        with self.assertRaisesMessage(InvalidImage, "too large"):
+            inspect_image(make_upload('image.jpg'))
+
+    def test_rejects_unsupported_format(self):
+        with self.assertRaises(InvalidImage):
+            inspect_image(make_upload('image.jpg', image_format='GIF'))
+
+    def test_rejects_mismatched_extension(self):
+        with self.assertRaises(InvalidImage):
+            inspect_image(make_upload('image.png'))
+
+    def test_rejects_garbage(self):
+        with self.assertRaises(InvalidImage):
+            inspect_image(SimpleUploadedFile(name='image.jpg', content=b"not an image"))
+
+    def test_content_hash(self):
+        upload = make_upload('image.jpg')
+        self.assertEqual(content_hash(upload), hashlib.sha256(upload.read()).hexdigest())
+
+
+class UploadIngestionTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(user=self.user)
+
+    @override_settings(IMAGE_MAX_PIXELS=599)
+    def test_upload_over_pixel_limit_is_rejected(self):
+        response = self.client.post(reverse('image-list'), {'image_file': make_upload('image.jpg')},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+    def test_upload_records_metadata(self):
+        upload = make_upload('image.jpg', size=(40, 25))
+
+        response = self.client.post(reverse('image-list'), {'image_file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual({field: response.data[field] for field in ('width', 'height', 'format', 'byte_size')},
+                         {'width': 40, 'height': 25, 'format': 'JPEG', 'byte_size': upload.size})
+
+    def test_replaced_file_is_rehashed(self):
+        response = self.client.post(reverse('image-list'), {'image_file': make_upload('red.jpg', color='red')},
+                                    format='multipart')
+        image = Image.objects.get(pk=response.data['id'])
+        Image.objects.filter(pk=image.pk).update(phash='0123456789abcdef')
+        blue = make_upload('blue.jpg', size=(50, 5))
+        blue_hash = content_hash(blue)
+
+        response = self.client.patch(reverse('image-detail', args=[image.id]), {'image_file': blue},
+                                     format='multipart')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['width'], response.data['height']), (50, 5))
+        image.refresh_from_db()
+        self.assertEqual(image.content_hash, blue_hash)
+        self.assertEqual((image.width, image.height, image.byte_size, image.phash), (50, 5, blue.size, ''))
+
+        # Another upload of the red picture gets a red file, not the blue one.
+        response = self.client.post(reverse('image-list'), {'image_file': make_upload('red.jpg', color='red')},
+                                    format='multipart')
+        again = Image.objects.get(pk=response.data['id'])
+        self.assertNotEqual(again.image_file.name, image.image_file.name)
+        with again.image_file.open('rb') as file, PilImage.open(file) as img:
+            self.assertGreater(img.getpixel((0, 0))[0], 200)
+
+    def test_replaced_file_gets_new_thumbnails(self):
+        size = ThumbnailSize.objects.create(size=10)
+        plan = Plan.objects.create(name='Basic')
+        plan.thumbnail_sizes.add(size)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+        response = self.client.post(reverse('image-list'), {'image_file': make_upload('red.jpg', color='red')},
+                                    format='multipart')
+        image = Image.objects.get(pk=response.data['id'])
+        red_original = image.image_file.path
+        red_thumbnail = image.create_thumbnail(10)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse('image-detail', args=[image.id]), {'image_file': make_upload('blue.jpg')},
+                              format='multipart')
+
+        self.assertFalse(os.path.exists(red_original))
+        self.assertFalse(thumbnail_storage().exists(red_thumbnail))
+        self.assertEqual(list(image.thumbnails.values_list('status', flat=True)), [Thumbnail.PENDING])
+        self.assertTrue(ThumbnailTask.objects.filter(image=image, status=ThumbnailTask.QUEUED).exists())
+
+        # Another user's upload of the blue picture is not given the red thumbnail.
+        other = User.objects.create_user(username='other', password='testpassword')
+        other.profile.plan = plan
+        other.profile.save()
+        self.client.force_authenticate(user=other)
+        response = self.client.post(reverse('image-list'), {'image_file': make_upload('blue.jpg')},
+                                    format='multipart')
+        self.assertEqual(Thumbnail.objects.get(image_id=response.data['id']).status, Thumbnail.PENDING)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_large_upload_is_spooled_to_disk(self):
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            upload = SimpleUploadedFile(name='test_image.jpg', content=img_file.read())
+
+        response = self.client.post(reverse('image-list'), {'image_file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
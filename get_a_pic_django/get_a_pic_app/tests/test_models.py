@@ -1,9 +1,15 @@
+import io
+from unittest import mock
+
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
-from ..models import Image, UserProfile, Plan, ThumbnailSize
+from PIL import ExifTags, ImageCms, Image as PilImage
+from ..models import Image, UserProfile, Plan, ThumbnailSize, Thumbnail
+from ..storage import CONTENT_VERSION_RE, is_versioned_name, shard_name
 from django.contrib.auth.models import User
 import os
-from django.db import IntegrityError
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.conf import settings
 
 
@@ -32,10 +38,181 @@ class ImageModelTestCase(TestCase):
         sizes = [200, 400]
         for size in sizes:
             thumbnail_path = self.image.create_thumbnail(size=size)
-            expected_path_format = f"thumbnails/{self.image.id}_{size}.jpg"
-            self.assertEqual(thumbnail_path, expected_path_format)
+            expected_path_format = shard_name(f"thumbnails/{self.image.id}_{size}.jpg")
+            self.assertTrue(is_versioned_name(thumbnail_path))
+            self.assertEqual(CONTENT_VERSION_RE.sub('', thumbnail_path), expected_path_format)
             self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, thumbnail_path)))
 
+    def test_create_thumbnails_in_one_batch(self):
+        # The size lookup, the thumbnail upsert, on the first render the perceptual hash, and the library version.
+        with self.assertNumQueries(4):
+            paths = self.image.create_thumbnails([200, 400])
+
+        self.assertEqual({size: CONTENT_VERSION_RE.sub('', path) for size, path in paths.items()},
+                         {size: shard_name(f"thumbnails/{self.image.id}_{size}.jpg") for size in (200, 400)})
+        self.assertEqual(self.image.thumbnails.filter(status=Thumbnail.READY).count(), 2)
+        for size, path in paths.items():
+            with PilImage.open(os.path.join(settings.MEDIA_ROOT, path)) as thumb:
+                self.assertEqual(thumb.height, size)
+
+    def test_variant_is_versioned_next_to_its_thumbnail(self):
+        path = self.image.create_thumbnail(200)
+
+        variant = self.image.thumbnails.get().create_variant('webp', 80)
+
+        self.assertTrue(is_versioned_name(variant.file_path))
+        self.assertTrue(variant.file_path.endswith('.webp'))
+        self.assertEqual(os.path.dirname(variant.file_path), os.path.dirname(path))
+
+    def test_create_thumbnails_is_idempotent(self):
+        self.image.create_thumbnails([200])
+        self.image.create_thumbnails([200])
+        self.assertEqual(self.image.thumbnails.count(), 1)
+
+    def test_create_thumbnails_from_large_jpeg(self):
+        buffer = io.BytesIO()
+        PilImage.new('RGB', (3000, 2000), 'red').save(buffer, 'JPEG')
+        uploaded_image = SimpleUploadedFile(name='large.jpg', content=buffer.getvalue(), content_type='image/jpeg')
+        image = Image.objects.create(image_file=uploaded_image, user=self.user)
+
+        paths = image.create_thumbnails([200, 400])
+
+        for size, path in paths.items():
+            with PilImage.open(os.path.join(settings.MEDIA_ROOT, path)) as thumb:
+                self.assertEqual(thumb.size, (int(size * 1.5), size))
+
+    def test_create_thumbnails_unknown_size(self):
+        with self.assertRaises(ValueError):
+            self.image.create_thumbnails([300])
+
+    def test_metadata_is_read_at_upload_and_hashed_at_first_render(self):
+        self.assertEqual((self.image.width, self.image.height, self.image.format), (4275, 2539, 'JPEG'))
+        self.assertEqual(self.image.byte_size, os.path.getsize(self.image_path))
+        self.assertEqual(self.image.phash, '')
+
+        self.image.create_thumbnails([200])
+
+        self.assertRegex(Image.objects.get(pk=self.image.pk).phash, r'^[0-9a-f]{16}$')
+        with self.assertNumQueries(3):
+            self.image.create_thumbnails([200])
+
+    def test_create_thumbnails_fills_missing_metadata(self):
+        Image.objects.filter(pk=self.image.pk).update(width=None, height=None, format='', byte_size=None)
+        image = Image.objects.get(pk=self.image.pk)
+
+        image.create_thumbnails([200])
+
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height, image.format), (4275, 2539, 'JPEG'))
+        self.assertEqual(image.byte_size, os.path.getsize(self.image_path))
+
+    def _upload(self, img, **params):
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', **params)
+        upload = SimpleUploadedFile(name='photo.jpg', content=buffer.getvalue(), content_type='image/jpeg')
+        return Image.objects.create(image_file=upload, user=self.user)
+
+    def test_thumbnail_is_turned_upright(self):
+        # Stored sideways: red on top; orientation 6 shows the top on the right.
+        img = PilImage.new('RGB', (600, 400), 'blue')
+        img.paste('red', (0, 0, 600, 200))
+        exif = PilImage.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        image = self._upload(img, exif=exif.tobytes())
+
+        path = image.create_thumbnail(200)
+
+        with PilImage.open(os.path.join(settings.MEDIA_ROOT, path)) as thumb:
+            self.assertEqual(thumb.size, (133, 200))
+            red, _, blue = thumb.convert('RGB').getpixel((120, 100))
+            self.assertGreater(red, 200)
+            self.assertLess(blue, 50)
+
+    def test_thumbnail_drops_metadata_and_is_progressive(self):
+        exif = PilImage.Exif()
+        exif[ExifTags.Base.Make] = 'Camera'
+        icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        image = self._upload(PilImage.new('RGB', (600, 400), 'green'), exif=exif.tobytes(), icc_profile=icc_profile)
+
+        path = image.create_thumbnail(200)
+
+        with PilImage.open(os.path.join(settings.MEDIA_ROOT, path)) as thumb:
+            self.assertNotIn('icc_profile', thumb.info)
+            self.assertNotIn('exif', thumb.info)
+            self.assertTrue(thumb.info.get('progressive'))
+
+    def test_thumbnail_size_can_keep_metadata(self):
+        ThumbnailSize.objects.filter(size=200).update(keep_metadata=True)
+        exif = PilImage.Exif()
+        exif[ExifTags.Base.Make] = 'Camera'
+        exif[ExifTags.Base.Orientation] = 3
+        icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        image = self._upload(PilImage.new('RGB', (600, 400), 'green'), exif=exif.tobytes(), icc_profile=icc_profile)
+
+        path = image.create_thumbnail(200)
+
+        with PilImage.open(os.path.join(settings.MEDIA_ROOT, path)) as thumb:
+            self.assertEqual(thumb.info['icc_profile'], icc_profile)
+            self.assertEqual(thumb.getexif()[ExifTags.Base.Make], 'Camera')
+            self.assertEqual(thumb.getexif()[ExifTags.Base.Orientation], 1)
+
+    def test_delete_removes_files_on_commit(self):
+        path = self.image.create_thumbnail(200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.image.delete()
+
+        self.assertFalse(os.path.exists(self.image.image_file.path))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, path)))
+
+    def test_files_of_a_transaction_are_deleted_by_one_callback(self):
+        paths = self.image.create_thumbnails([200, 400])
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.image.delete()
+
+        self.assertEqual(len(callbacks), 1)
+        for path in paths.values():
+            self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, path)))
+
+    def test_files_are_deleted_after_a_rolled_back_delete(self):
+        copy = Image.objects.create(image_file=self.image.image_file.name, user=self.user,
+                                    content_hash=self.image.content_hash)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Image.objects.filter(pk=copy.pk).delete()
+                raise IntegrityError("rolled back")
+            self.image.delete()
+        self.assertTrue(os.path.exists(copy.image_file.path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.delete()
+        self.assertFalse(os.path.exists(copy.image_file.path))
+
+    def test_shared_original_is_kept_until_its_last_image(self):
+        copy = Image.objects.create(image_file=self.image.image_file.name, user=self.user,
+                                    content_hash=self.image.content_hash)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.image.delete()
+        self.assertTrue(os.path.exists(copy.image_file.path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.delete()
+        self.assertFalse(os.path.exists(copy.image_file.path))
+
+    def test_failed_render_leaves_no_files(self):
+        directory = os.path.join(settings.MEDIA_ROOT, os.path.dirname(shard_name(f"thumbnails/{self.image.id}_200.jpg")))
+        os.makedirs(directory, exist_ok=True)
+        before = set(os.listdir(directory))
+
+        with mock.patch.object(Thumbnail.objects, 'bulk_create', side_effect=IntegrityError("conflict")):
+            with self.assertRaises(ValueError):
+                self.image.create_thumbnails([200])
+
+        self.assertEqual(set(os.listdir(directory)) - before, set())
+
     def test_image_belongs_to_user(self):
         self.assertEqual(self.image.user, self.user)
 
@@ -161,3 +338,11 @@ class PlanModelTestCase(TestCase):
 
         self.assertTrue(basic_plan.has_original_image_link)
         self.assertTrue(basic_plan.can_generate_expiring_link)
+
+    def test_thumbnail_formats_must_be_variant_formats(self):
+        self.plan.thumbnail_formats = 'AVIF, webp'
+        self.plan.full_clean()
+
+        self.plan.thumbnail_formats = 'webp,gif'
+        with self.assertRaisesMessage(ValidationError, "Unknown thumbnail formats: gif"):
+            self.plan.full_clean()
@@ -0,0 +1,201 @@
+import io
+import os
+import tempfile
+import unittest
+import uuid
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from PIL import Image as PilImage
+from rest_framework.test import APIClient
+from ..models import Image, Plan, ThumbnailSize, User
+from ..storage import MmapFileSystemStorage, ShardedFileSystemStorage, is_versioned_name, shard_name, \
+    thumbnail_storage, versioned_name
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+STORAGES = {
+    'default': {'BACKEND': 'get_a_pic_app.storage.ShardedFileSystemStorage'},
+    'thumbnails': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+class ShardedFileSystemStorageTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_versioned_name(self):
+        name = versioned_name('thumbnails/5_200.jpg', 'ab' * 32)
+
+        self.assertEqual(name, 'thumbnails/5_200.abababababab.jpg')
+        self.assertTrue(is_versioned_name(name))
+        self.assertFalse(is_versioned_name('thumbnails/5_200.jpg'))
+        self.assertEqual(versioned_name(name, 'cd' * 32), 'thumbnails/5_200.cdcdcdcdcdcd.jpg')
+        self.assertEqual(os.path.dirname(shard_name(name)), os.path.dirname(shard_name('thumbnails/5_200.jpg')))
+
+    def test_shard_name(self):
+        self.assertRegex(shard_name('thumbnails/5_200.jpg'), r'^thumbnails/[0-9a-f]{2}/[0-9a-f]{2}/5_200\.jpg$')
+        self.assertEqual(os.path.dirname(shard_name('thumbnails/5_200.jpg')),
+                         os.path.dirname(shard_name('thumbnails/5_200.webp')))
+        self.assertEqual(shard_name(shard_name('thumbnails/5_200.jpg')), shard_name('thumbnails/5_200.jpg'))
+        self.assertEqual(shard_name('other/5_200.jpg'), 'other/5_200.jpg')
+
+    def test_saved_names_include_the_shard(self):
+        storage = ShardedFileSystemStorage(location=self.directory.name)
+
+        name = storage.save('thumbnails/5_200.jpg', ContentFile(b"data"))
+
+        self.assertEqual(name, shard_name('thumbnails/5_200.jpg'))
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, name)))
+
+    def test_file_overwrite_replaces_existing_file(self):
+        storage = ShardedFileSystemStorage(location=self.directory.name, file_overwrite=True)
+
+        first = storage.save('thumbnails/5_200.jpg', ContentFile(b"old"))
+        second = storage.save('thumbnails/5_200.jpg', ContentFile(b"new"))
+
+        self.assertEqual(first, second)
+        with storage.open(second) as file:
+            self.assertEqual(file.read(), b"new")
+
+    def test_file_overwrite_survives_a_racing_writer(self):
+        storage = ShardedFileSystemStorage(location=self.directory.name, file_overwrite=True)
+        name = storage.save('thumbnails/5_200.jpg', ContentFile(b"old"))
+        path = storage.path(name)
+
+        class RacingContent(ContentFile):
+            def chunks(self, chunk_size=None):
+                # Another render writes the same name while this one is writing.
+                with open(path, 'wb') as file:
+                    file.write(b"other")
+                return super().chunks(chunk_size)
+
+        self.assertEqual(storage.save('thumbnails/5_200.jpg', RacingContent(b"new")), name)
+        with storage.open(name) as file:
+            self.assertEqual(file.read(), b"new")
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_unique_names_without_overwrite(self):
+        storage = ShardedFileSystemStorage(location=self.directory.name)
+        first = storage.save('uploaded_images/a.jpg', ContentFile(b"one"))
+        second = storage.save('uploaded_images/a.jpg', ContentFile(b"two"))
+        self.assertNotEqual(first, second)
+
+    def test_mmap_storage_reads(self):
+        storage = MmapFileSystemStorage(location=self.directory.name)
+        buffer = io.BytesIO()
+        PilImage.new('RGB', (30, 20), 'red').save(buffer, 'PNG')
+        name = storage.save('uploaded_images/red.png', ContentFile(buffer.getvalue()))
+
+        with storage.open(name) as file, PilImage.open(file) as img:
+            self.assertEqual(file.size, len(buffer.getvalue()))
+            self.assertEqual(img.size, (30, 20))
+
+
+class ObjectStorageDeliveryTest(TestCase):
+    """Thumbnails in a storage without local paths are written, listed and streamed through the storage API."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(user=self.user)
+        size_200 = ThumbnailSize.objects.create(size=200)
+        plan = Plan.objects.create(name='Basic')
+        plan.thumbnail_sizes.add(size_200)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            image_file = SimpleUploadedFile(name='test_image.jpg', content=img_file.read(), content_type='image/jpeg')
+        self.image = Image.objects.create(user=self.user, image_file=image_file)
+
+    @override_settings(STORAGES=STORAGES)
+    def test_thumbnail_is_rendered_into_and_served_from_storage(self):
+        url = reverse('image-thumbnail', args=[self.image.id, 200])
+
+        response = self.client.get(url)
+        body = b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, 200)
+        name = self.image.thumbnails.get().file_path
+        with thumbnail_storage().open(name) as file:
+            self.assertEqual(body, file.read())
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(b''.join(response.streaming_content)), 10)
+
+    @override_settings(STORAGES=STORAGES, FILE_DELIVERY_MODE='redirect')
+    def test_redirect_delivery(self):
+        response = self.client.get(reverse('image-thumbnail', args=[self.image.id, 200]))
+        self.assertEqual(response.status_code, 302)
+
+
+@unittest.skipUnless(boto3 is not None and os.environ.get('S3_TEST_ENDPOINT_URL'),
+                     "set S3_TEST_ENDPOINT_URL (e.g. a MinIO container) and install boto3 to run")
+class S3StorageTest(SimpleTestCase):
+    """Runs against a local S3 stand-in: `docker-compose --profile s3 up minio`."""
+
+    def setUp(self):
+        from ..storage import S3Storage
+        self.storage = S3Storage(
+            bucket_name=os.environ.get('S3_TEST_BUCKET', 'get-a-pic-test'),
+            location=f"test-{uuid.uuid4().hex}",
+            endpoint_url=os.environ['S3_TEST_ENDPOINT_URL'],
+            access_key=os.environ.get('S3_TEST_ACCESS_KEY', 'minioadmin'),
+            secret_key=os.environ.get('S3_TEST_SECRET_KEY', 'minioadmin'),
+            multipart_threshold=5 * 1024 * 1024,
+            multipart_chunksize=5 * 1024 * 1024,
+        )
+        try:
+            self.storage.client.create_bucket(Bucket=self.storage.bucket_name)
+        except self.storage.client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+    def test_round_trip(self):
+        name = self.storage.save('thumbnails/5_200.jpg', ContentFile(b"data"))
+
+        self.assertEqual(name, shard_name('thumbnails/5_200.jpg'))
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.storage.size(name), 4)
+        with self.storage.open(name) as file:
+            self.assertEqual(file.read(), b"data")
+
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+
+    def test_unique_names_without_overwrite(self):
+        first = self.storage.save('uploaded_images/photo.jpg', ContentFile(b"one"))
+        second = self.storage.save('uploaded_images/photo.jpg', ContentFile(b"two"))
+        self.addCleanup(self.storage.delete, first)
+        self.addCleanup(self.storage.delete, second)
+
+        self.assertNotEqual(first, second)
+        with self.storage.open(first) as file:
+            self.assertEqual(file.read(), b"one")
+
+    def test_iter_files(self):
+        names = {self.storage.save(f'thumbnails/{index}_200.jpg', ContentFile(b"data")) for index in range(3)}
+        for name in names:
+            self.addCleanup(self.storage.delete, name)
+
+        self.assertEqual(set(self.storage.iter_files('thumbnails')), names)
+
+    def test_multipart_upload(self):
+        content = os.urandom(12 * 1024 * 1024)
+        name = self.storage.save('uploaded_images/large.bin', ContentFile(content))
+        self.addCleanup(self.storage.delete, name)
+
+        self.assertEqual(self.storage.size(name), len(content))
+        head = self.storage.client.head_object(Bucket=self.storage.bucket_name, Key=self.storage._key(name))
+        self.assertIn('-', head['ETag'])
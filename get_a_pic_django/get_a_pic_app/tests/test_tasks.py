@@ -0,0 +1,271 @@
+import io
+import os
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image as PilImage
+from rest_framework.test import APIClient
+from ..models import Image, Plan, Thumbnail, ThumbnailSize, ThumbnailTask, User, decode_memory
+from ..tasks import enqueue_thumbnails, enqueue_thumbnails_bulk, claim_task, process_task, process_tasks, \
+    requeue_stale_tasks, run_worker
+
+
+class PlanUserMixin:
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.size_200 = ThumbnailSize.objects.create(size=200)
+        self.size_400 = ThumbnailSize.objects.create(size=400)
+        plan = Plan.objects.create(name='Premium', has_original_image_link=True)
+        plan.thumbnail_sizes.add(self.size_200, self.size_400)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        self.current_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(self.current_dir, 'test_image.jpg'), 'rb') as file:
+            self.image_content = file.read()
+
+    def _create_image(self):
+        uploaded_image = SimpleUploadedFile(name='test_image.jpg', content=self.image_content,
+                                            content_type='image/jpeg')
+        return Image.objects.create(image_file=uploaded_image, user=self.user)
+
+
+class ThumbnailQueueTestCase(PlanUserMixin, TestCase):
+
+    def test_upload_returns_pending_thumbnails(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        image_file = SimpleUploadedFile(name='test_image.jpg', content=self.image_content, content_type='image/jpeg')
+
+        response = client.post(reverse('image-list'), {'image_file': image_file}, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['thumbnail_status'], {'200': 'pending', '400': 'pending'})
+        self.assertEqual(ThumbnailTask.objects.filter(status=ThumbnailTask.QUEUED).count(), 1)
+
+    def test_worker_renders_pending_thumbnails(self):
+        image = self._create_image()
+        enqueue_thumbnails(image)
+
+        self.assertEqual(run_worker(once=True), 1)
+
+        thumbnails = image.thumbnails.all()
+        self.assertEqual(len(thumbnails), 2)
+        for thumbnail in thumbnails:
+            self.assertEqual(thumbnail.status, Thumbnail.READY)
+            self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, thumbnail.file_path)))
+        self.assertEqual(ThumbnailTask.objects.get().status, ThumbnailTask.DONE)
+
+    def test_claim_task_skips_running_tasks(self):
+        image = self._create_image()
+        enqueue_thumbnails(image)
+
+        task = claim_task()
+
+        self.assertEqual(task.status, ThumbnailTask.RUNNING)
+        self.assertEqual(task.attempts, 1)
+        self.assertIsNone(claim_task())
+
+    @override_settings(THUMBNAIL_TASK_MAX_ATTEMPTS=1)
+    def test_failed_task_marks_thumbnails_failed(self):
+        image = self._create_image()
+        enqueue_thumbnails(image)
+        image.image_file.storage.delete(image.image_file.name)
+
+        self.assertFalse(process_task(claim_task()))
+
+        self.assertEqual(ThumbnailTask.objects.get().status, ThumbnailTask.FAILED)
+        self.assertFalse(image.thumbnails.exclude(status=Thumbnail.FAILED).exists())
+
+    def test_stale_task_is_requeued(self):
+        image = self._create_image()
+        enqueue_thumbnails(image)
+        task = claim_task()
+        ThumbnailTask.objects.filter(pk=task.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(requeue_stale_tasks(), 1)
+
+        self.assertEqual(ThumbnailTask.objects.get().status, ThumbnailTask.QUEUED)
+
+    @override_settings(THUMBNAIL_TASK_MAX_ATTEMPTS=2)
+    def test_stale_task_out_of_attempts_fails(self):
+        image = self._create_image()
+        enqueue_thumbnails(image)
+        task = claim_task()
+        ThumbnailTask.objects.filter(pk=task.pk).update(attempts=2, updated_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(requeue_stale_tasks(), 0)
+
+        self.assertEqual(ThumbnailTask.objects.get().status, ThumbnailTask.FAILED)
+        self.assertFalse(image.thumbnails.exclude(status=Thumbnail.FAILED).exists())
+
+    def test_running_task_is_not_requeued(self):
+        image = self._create_image()
+        enqueue_thumbnails(image)
+        claim_task()
+
+        self.assertEqual(requeue_stale_tasks(), 0)
+
+    @override_settings(THUMBNAIL_TASKS_EAGER=True)
+    def test_eager_mode_renders_on_commit(self):
+        image = self._create_image()
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue_thumbnails(image)
+
+        self.assertFalse(image.thumbnails.exclude(status=Thumbnail.READY).exists())
+
+    @override_settings(THUMBNAIL_TASKS_EAGER=True, THUMBNAIL_WORKER_PROCESSES=4)
+    def test_eager_bulk_renders_inline(self):
+        images = [self._create_image(), self._create_image()]
+        with mock.patch('get_a_pic_app.tasks.ProcessPoolExecutor') as pool, \
+                self.captureOnCommitCallbacks(execute=True):
+            enqueue_thumbnails_bulk(images, [self.size_200, self.size_400])
+
+        pool.assert_not_called()
+        self.assertFalse(Thumbnail.objects.filter(image__in=images).exclude(status=Thumbnail.READY).exists())
+
+
+class MemoryBudgetTestCase(PlanUserMixin, TestCase):
+
+    def _create_generated_image(self, size, file_format, extension):
+        buffer = io.BytesIO()
+        PilImage.new('RGB', size, 'red').save(buffer, file_format)
+        uploaded_image = SimpleUploadedFile(name=f'large.{extension}', content=buffer.getvalue())
+        return Image.objects.create(image_file=uploaded_image, user=self.user)
+
+    def test_decode_memory(self):
+        buffer = io.BytesIO()
+        PilImage.new('RGB', (100, 50)).save(buffer, 'JPEG', progressive=True)
+        with PilImage.open(buffer) as img:
+            # Four bytes per decoded pixel, plus the coefficients of a progressive JPEG.
+            self.assertEqual(decode_memory(img, img.size), 100 * 50 * 4 + 100 * 50 * 3 * 2)
+
+    @override_settings(THUMBNAIL_MEMORY_BUDGET=1024 * 1024)
+    def test_large_png_moves_to_large_queue(self):
+        image = self._create_generated_image((1600, 1200), 'PNG', 'png')
+        enqueue_thumbnails(image)
+
+        run_worker(once=True)
+
+        task = ThumbnailTask.objects.get()
+        self.assertEqual((task.queue, task.status, task.attempts),
+                         (ThumbnailTask.LARGE_QUEUE, ThumbnailTask.QUEUED, 0))
+        self.assertFalse(image.thumbnails.exclude(status=Thumbnail.PENDING).exists())
+
+        self.assertEqual(run_worker(once=True, queue=ThumbnailTask.LARGE_QUEUE), 1)
+
+        self.assertFalse(image.thumbnails.exclude(status=Thumbnail.READY).exists())
+
+    @override_settings(THUMBNAIL_MEMORY_BUDGET=1024 * 1024)
+    def test_large_jpeg_fits_after_draft(self):
+        image = self._create_generated_image((1600, 1200), 'JPEG', 'jpg')
+        enqueue_thumbnails(image, [self.size_200])
+
+        run_worker(once=True)
+
+        self.assertEqual(ThumbnailTask.objects.get().status, ThumbnailTask.DONE)
+
+    @override_settings(THUMBNAIL_MEMORY_BUDGET=1024 * 1024)
+    def test_on_demand_render_of_large_image_is_deferred(self):
+        image = self._create_generated_image((1600, 1200), 'PNG', 'png')
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        response = client.get(reverse('image-thumbnail', args=[image.id, 200]))
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Retry-After'], '10')
+        self.assertEqual(ThumbnailTask.objects.get().queue, ThumbnailTask.LARGE_QUEUE)
+
+
+class DeduplicationTestCase(PlanUserMixin, TestCase):
+
+    def _upload(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        image_file = SimpleUploadedFile(name='test_image.jpg', content=self.image_content, content_type='image/jpeg')
+        response = client.post(reverse('image-list'), {'image_file': image_file}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        return Image.objects.get(pk=response.data['id'])
+
+    def test_content_hash_is_stored(self):
+        image = self._create_image()
+        self.assertEqual(len(image.content_hash), 64)
+
+    def test_identical_upload_reuses_stored_original(self):
+        first = self._upload()
+        second = self._upload()
+
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertEqual(first.image_file.name, second.image_file.name)
+
+    def test_identical_upload_reuses_rendered_thumbnails(self):
+        first = self._upload()
+        run_worker(once=True)
+
+        second = self._upload()
+
+        self.assertFalse(ThumbnailTask.objects.filter(image=second).exists())
+        self.assertEqual(
+            dict(second.thumbnails.values_list('thumbnail_size__size', 'file_path')),
+            dict(first.thumbnails.values_list('thumbnail_size__size', 'file_path')),
+        )
+        self.assertFalse(second.thumbnails.exclude(status=Thumbnail.READY).exists())
+
+
+class BulkUploadTestCase(PlanUserMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def _upload(self, name, color):
+        buffer = io.BytesIO()
+        PilImage.new('RGB', (60, 40), color).save(buffer, 'JPEG')
+        return SimpleUploadedFile(name=name, content=buffer.getvalue(), content_type='image/jpeg')
+
+    def test_bulk_upload_reports_per_file_results(self):
+        files = [self._upload('red.jpg', 'red'), SimpleUploadedFile(name='bad.txt', content=b"nope"),
+                 self._upload('green.jpg', 'green')]
+
+        response = self.client.post(reverse('image-bulk-upload'), {'image_files': files}, format='multipart')
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result['status'] for result in response.data['results']], [201, 400, 201])
+        self.assertIn('image_file', response.data['results'][1]['errors'])
+        self.assertEqual(Image.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(ThumbnailTask.objects.count(), 2)
+        self.assertEqual(response.data['results'][0]['image']['thumbnail_status'], {'200': 'pending', '400': 'pending'})
+
+    def test_bulk_upload_stores_identical_files_once(self):
+        files = [self._upload('a.jpg', 'red'), self._upload('b.jpg', 'red')]
+
+        response = self.client.post(reverse('image-bulk-upload'), {'image_files': files}, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(set(Image.objects.values_list('image_file', flat=True))), 1)
+
+    def test_bulk_upload_all_invalid(self):
+        files = [SimpleUploadedFile(name='bad.txt', content=b"nope")]
+        response = self.client.post(reverse('image-bulk-upload'), {'image_files': files}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Image.objects.exists())
+
+    def test_bulk_upload_requires_files(self):
+        response = self.client.post(reverse('image-bulk-upload'), {}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+    def test_process_tasks_renders_in_process(self):
+        images = [self._create_image(), self._create_image()]
+        for image in images:
+            enqueue_thumbnails(image)
+
+        self.assertEqual(process_tasks(list(ThumbnailTask.objects.values_list('id', flat=True)), processes=1),
+                         [True, True])
+        self.assertFalse(Thumbnail.objects.exclude(status=Thumbnail.READY).exists())
@@ -1,9 +1,23 @@
 import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APIClient
-from ..models import UserProfile, Image, Plan, ThumbnailSize, User
+from .. import tasks
+from ..downloads import negotiate_format
+from ..entitlements import USER_KEY_PREFIX, get_entitlements, local_cache as local_cache_entitlements
+from ..models import UserProfile, Image, Plan, ThumbnailSize, User, ExpiringLink, Thumbnail, ThumbnailVariant
+from ..link_cache import local_cache
+from ..signed_links import make_signed_link
+from ..storage import thumbnail_storage
+from ..views import UserProfileViewSet
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 
@@ -46,6 +60,85 @@ class PlanViewSetTest(TestCase):
         self.assertEqual(len(response.data), 1)
 
 
+class PlanAssignmentTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=User.objects.create_superuser(username='adminuser', password='pass'))
+        self.size_200 = ThumbnailSize.objects.create(size=200)
+        self.size_400 = ThumbnailSize.objects.create(size=400)
+        self.basic = Plan.objects.create(name='Basic')
+        self.basic.thumbnail_sizes.add(self.size_200)
+        self.premium = Plan.objects.create(name='Premium')
+        self.premium.thumbnail_sizes.add(self.size_200, self.size_400)
+
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg'), 'rb') as file:
+            content = file.read()
+        self.users, self.images = [], []
+        for name in ('first', 'second'):
+            user = User.objects.create_user(username=name, password='pass')
+            user.profile.plan = self.premium
+            user.profile.save()
+            image = Image.objects.create(user=user, image_file=SimpleUploadedFile(name='test_image.jpg', content=content))
+            image.create_thumbnails([200, 400])
+            self.users.append(user)
+            self.images.append(image)
+
+    def _assign(self, plan, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('plan-assign-users', args=[plan.id]), data, format='json')
+
+    def test_downgrade_removes_dropped_sizes(self):
+        path = self.images[0].thumbnails.get(thumbnail_size=self.size_400).file_path
+
+        response = self._assign(self.basic, {'from_plan': self.premium.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'users': 2, 'thumbnails_removed': 2, 'thumbnails_queued': 0})
+        self.assertFalse(Thumbnail.objects.filter(thumbnail_size=self.size_400).exists())
+        self.assertEqual(Thumbnail.objects.filter(thumbnail_size=self.size_200).count(), 2)
+        self.assertFalse(thumbnail_storage().exists(path))
+        self.assertEqual(get_entitlements(self.users[0]).thumbnail_sizes, (self.size_200,))
+
+    def test_shared_file_is_kept_while_referenced(self):
+        # Identical originals share their thumbnail files, as deduplicated renders do.
+        path = self.images[0].thumbnails.get(thumbnail_size=self.size_400).file_path
+        self.images[1].thumbnails.filter(thumbnail_size=self.size_400).update(file_path=path)
+
+        self._assign(self.basic, {'users': [self.users[0].id]})
+
+        self.assertFalse(self.images[0].thumbnails.filter(thumbnail_size=self.size_400).exists())
+        self.assertTrue(thumbnail_storage().exists(path))
+
+    def test_upgrade_queues_only_missing_sizes(self):
+        self._assign(self.basic, {'from_plan': self.premium.id})
+
+        with mock.patch('get_a_pic_app.tasks.enqueue_thumbnails_bulk', wraps=tasks.enqueue_thumbnails_bulk) as bulk:
+            response = self._assign(self.premium, {'users': [user.id for user in self.users]})
+
+        self.assertEqual(response.data['users'], 2)
+        self.assertEqual(response.data['thumbnails_queued'], 2)
+        self.assertEqual(bulk.call_args.args[1], [self.size_400])
+        self.assertEqual(Thumbnail.objects.filter(thumbnail_size=self.size_400, status=Thumbnail.PENDING).count(), 2)
+
+    def test_cached_plan_is_evicted_when_the_batch_commits(self):
+        key = USER_KEY_PREFIX + str(self.users[0].id)
+
+        def concurrent_request(images):
+            # A request from the moved user, while the batch is still being enqueued, reads the old plan.
+            cache.set(key, self.premium.id)
+            local_cache_entitlements.set(key, self.premium.id, 60)
+            return []
+
+        with mock.patch('get_a_pic_app.tasks.enqueue_missing_thumbnails', side_effect=concurrent_request):
+            self._assign(self.basic, {'users': [self.users[0].id]})
+
+        self.assertEqual(get_entitlements(self.users[0]).plan_id, self.basic.id)
+
+    def test_requires_users_or_from_plan(self):
+        response = self.client.post(reverse('plan-assign-users', args=[self.basic.id]), {}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
 class ThumbnailSizeViewSetTest(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -90,7 +183,7 @@ class ImageViewSetTest(TestCase):
 
         response = self.client.get(reverse('image-list'))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_no_access_for_authenticated(self):
         self.client.logout()
@@ -109,3 +202,538 @@ class ImageViewSetTest(TestCase):
     def test_upload_wrong_type(self):
         response = self.client.post(reverse('image-list'), {'image-file': self.image_file}, format='multipart')
         self.assertEqual(response.status_code, 400)
+
+    def test_list_filters_by_metadata(self):
+        now = timezone.now()
+        small, large, png = Image.objects.bulk_create([
+            Image(user=self.user, image_file='uploaded_images/small.jpg', width=640, height=480, format='JPEG',
+                  byte_size=50_000),
+            Image(user=self.user, image_file='uploaded_images/large.jpg', width=4000, height=3000, format='JPEG',
+                  byte_size=4_000_000),
+            Image(user=self.user, image_file='uploaded_images/scan.png', width=2000, height=3000, format='PNG',
+                  byte_size=9_000_000),
+        ])
+        Image.objects.filter(pk=small.pk).update(uploaded_at=now - timedelta(days=10))
+
+        def listed(**params):
+            response = self.client.get(reverse('image-list'), params)
+            self.assertEqual(response.status_code, 200)
+            return {image['id'] for image in response.data['results']}
+
+        self.assertEqual(listed(min_width=1000), {large.id, png.id})
+        self.assertEqual(listed(min_width=1000, max_height=3000, image_format='PNG'), {png.id})
+        self.assertEqual(listed(max_byte_size=1_000_000), {small.id})
+        self.assertEqual(listed(uploaded_before=(now - timedelta(days=1)).isoformat()), {small.id})
+        self.assertEqual(listed(uploaded_after=(now - timedelta(days=1)).isoformat()), {large.id, png.id})
+        response = self.client.get(reverse('image-list'), {'min_width': 'wide'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ImageListQueryCountTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(user=self.user)
+        size_200 = ThumbnailSize.objects.create(size=200)
+        size_400 = ThumbnailSize.objects.create(size=400)
+        plan = Plan.objects.create(name='Premium', has_original_image_link=True)
+        plan.thumbnail_sizes.add(size_200, size_400)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            self.image_content = img_file.read()
+
+    def _add_images(self, count):
+        for _ in range(count):
+            image_file = SimpleUploadedFile(name='test_image.jpg', content=self.image_content,
+                                            content_type='image/jpeg')
+            image = Image.objects.create(user=self.user, image_file=image_file)
+            image.create_thumbnails([200, 400])
+
+    def _count_queries(self, url_name):
+        # Warm the entitlements cache so only per-request queries are counted.
+        self.client.get(reverse(url_name))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response
+
+    def test_image_list_query_count_is_constant(self):
+        self._add_images(1)
+        queries_for_one, _ = self._count_queries('image-list')
+
+        self._add_images(4)
+        queries_for_five, response = self._count_queries('image-list')
+
+        self.assertEqual(queries_for_one, queries_for_five)
+        self.assertRegex(response.data['results'][0]['thumbnails']['400'], r'/thumbnail/400/\?v=[0-9a-f]{12}$')
+
+    def test_userprofile_query_count_is_constant(self):
+        self._add_images(1)
+        queries_for_one, _ = self._count_queries('userprofile-list')
+
+        self._add_images(4)
+        queries_for_five, response = self._count_queries('userprofile-list')
+
+        self.assertEqual(queries_for_one, queries_for_five)
+        self.assertEqual(len(response.data[0]['images']), 5)
+
+    def test_image_list_cursor_pagination(self):
+        self._add_images(5)
+
+        response = self.client.get(reverse('image-list'), {'page_size': 2})
+        seen = [image['id'] for image in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen.extend(image['id'] for image in response.data['results'])
+
+        expected = list(Image.objects.order_by('-uploaded_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_image_list_invalid_cursor(self):
+        response = self.client.get(reverse('image-list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_image_list_sparse_fields(self):
+        self._add_images(1)
+
+        response = self.client.get(reverse('image-list'), {'fields': 'id,thumbnails'})
+
+        self.assertEqual(set(response.data['results'][0]), {'id', 'thumbnails'})
+
+    def test_userprofile_embeds_recent_images_only(self):
+        self._add_images(3)
+
+        with mock.patch.object(UserProfileViewSet, 'recent_images_count', 2):
+            response = self.client.get(reverse('userprofile-list'))
+
+        self.assertEqual(len(response.data[0]['images']), 2)
+        self.assertEqual(response.data[0]['images_count'], 3)
+
+
+class ExpiringLinkRetrieveTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(user=self.user)
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            self.image_content = img_file.read()
+        image_file = SimpleUploadedFile(name='test_image.jpg', content=self.image_content, content_type='image/jpeg')
+        self.image = Image.objects.create(user=self.user, image_file=image_file)
+        self.link = ExpiringLink.objects.create(image=self.image,
+                                                expiration_date=timezone.now() + timedelta(seconds=300))
+        self.url = reverse('expiringlink-retrieve-by-token', args=[self.link.link])
+
+    def test_retrieve_streams_whole_file(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(b''.join(response.streaming_content), self.image_content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_retrieve_requires_authentication(self):
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_retrieve_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.image_content[10:20])
+        self.assertEqual(response['Content-Range'], f"bytes 10-19/{len(self.image_content)}")
+
+    def test_retrieve_suffix_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.image_content[-5:])
+
+    def test_retrieve_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.image_content)}-")
+        self.assertEqual(response.status_code, 416)
+
+    def test_retrieve_stale_if_range_returns_whole_file(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_get_returns_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(FILE_DELIVERY_MODE='x-accel-redirect')
+    def test_retrieve_with_x_accel_redirect(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.image.image_file.name)
+        self.assertEqual(response.content, b'')
+
+    def test_expired_link(self):
+        self.link.expiration_date = timezone.now() - timedelta(seconds=1)
+        self.link.save()
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_resolution_is_cached(self):
+        self.client.get(self.url)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_shared_cache_fills_local_tier(self):
+        self.client.get(self.url)
+        local_cache.clear()
+
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+
+    def test_unknown_token_is_negatively_cached(self):
+        url = reverse('expiringlink-retrieve-by-token', args=['unknown'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_deleted_link_is_evicted(self):
+        self.client.get(self.url)
+        self.link.delete()
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 404)
+
+
+class SignedLinkTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        plan = Plan.objects.create(name='Enterprise', can_generate_expiring_link=True)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            self.image_content = img_file.read()
+        image_file = SimpleUploadedFile(name='test_image.jpg', content=self.image_content, content_type='image/jpeg')
+        self.image = Image.objects.create(user=self.user, image_file=image_file)
+
+    def test_create_signed_link_stores_no_row(self):
+        self.client.force_authenticate(user=self.user)
+
+        response = self.client.post(reverse('expiringlink-list'),
+                                    {'image': self.image.id, 'expiration_seconds': 300, 'mode': 'signed'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('/api/expiring-link/signed/', response.data['link'])
+        self.assertFalse(ExpiringLink.objects.exists())
+
+    def test_retrieve_without_queries(self):
+        url = reverse('expiringlink-retrieve-signed', args=[make_signed_link(self.image, 300)])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.image_content)
+
+    def test_tampered_token(self):
+        token = make_signed_link(self.image, 300)
+        url = reverse('expiringlink-retrieve-signed', args=[token[:-1] + ('A' if token[-1] != 'A' else 'B')])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_expired_token(self):
+        url = reverse('expiringlink-retrieve-signed', args=[make_signed_link(self.image, -1)])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_key_rotation(self):
+        with override_settings(SIGNED_LINK_KEY='old-key'):
+            url = reverse('expiringlink-retrieve-signed', args=[make_signed_link(self.image, 300)])
+
+        with override_settings(SIGNED_LINK_KEY='new-key', SIGNED_LINK_FALLBACK_KEYS=['old-key']):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        with override_settings(SIGNED_LINK_KEY='new-key'):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class OnDemandThumbnailTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(user=self.user)
+        self.size_200 = ThumbnailSize.objects.create(size=200)
+        ThumbnailSize.objects.create(size=400)
+        plan = Plan.objects.create(name='Basic')
+        plan.thumbnail_sizes.add(self.size_200)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            image_file = SimpleUploadedFile(name='test_image.jpg', content=img_file.read(), content_type='image/jpeg')
+        self.image = Image.objects.create(user=self.user, image_file=image_file)
+
+    def test_missing_thumbnail_is_rendered_on_first_request(self):
+        response = self.client.get(reverse('image-thumbnail', args=[self.image.id, 200]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        thumbnail = Thumbnail.objects.get(image=self.image, thumbnail_size=self.size_200)
+        self.assertEqual(thumbnail.status, Thumbnail.READY)
+
+    def test_rendered_thumbnail_is_served_from_cache(self):
+        url = reverse('image-thumbnail', args=[self.image.id, 200])
+        self.client.get(url)
+
+        with mock.patch.object(Image, 'create_thumbnails') as create_thumbnails:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        create_thumbnails.assert_not_called()
+
+    def test_size_outside_plan_is_forbidden(self):
+        response = self.client.get(reverse('image-thumbnail', args=[self.image.id, 400]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_other_users_image_is_not_found(self):
+        other = User.objects.create_user(username='other', password='testpassword')
+        self.client.force_authenticate(user=other)
+
+        response = self.client.get(reverse('image-thumbnail', args=[self.image.id, 200]))
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_list_links_missing_thumbnail_to_endpoint(self):
+        response = self.client.get(reverse('image-list'))
+
+        self.assertTrue(response.data['results'][0]['thumbnails']['200'].endswith(
+            reverse('image-thumbnail', args=[self.image.id, 200])))
+
+    def test_webp_variant_is_served_to_accepting_clients(self):
+        url = reverse('image-thumbnail', args=[self.image.id, 200])
+
+        response = self.client.get(url, HTTP_ACCEPT='image/webp,image/*;q=0.8')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        self.assertTrue(ThumbnailVariant.objects.filter(thumbnail__image=self.image, format='webp').exists())
+
+    def test_original_format_without_explicit_accept(self):
+        response = self.client.get(reverse('image-thumbnail', args=[self.image.id, 200]), HTTP_ACCEPT='image/*')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+    def test_format_not_offered_by_plan_falls_back(self):
+        response = self.client.get(reverse('image-thumbnail', args=[self.image.id, 200]), HTTP_ACCEPT='image/avif')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+
+class HttpCachingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(user=self.user)
+        size_200 = ThumbnailSize.objects.create(size=200)
+        plan = Plan.objects.create(name='Premium', has_original_image_link=True)
+        plan.thumbnail_sizes.add(size_200)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            self.image_content = img_file.read()
+        self.image = self._add_image()
+
+    def _add_image(self):
+        image_file = SimpleUploadedFile(name='test_image.jpg', content=self.image_content, content_type='image/jpeg')
+        image = Image.objects.create(user=self.user, image_file=image_file)
+        image.create_thumbnails([200])
+        return image
+
+    def test_image_list_revalidates_with_etag(self):
+        response = self.client.get(reverse('image-list'))
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('image-list'), HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_image_list_etag_changes_with_library(self):
+        etag = self.client.get(reverse('image-list'))['ETag']
+
+        Thumbnail.objects.filter(image=self.image).delete()
+        tasks.enqueue_thumbnails(self.image)
+        enqueued = self.client.get(reverse('image-list'), HTTP_IF_NONE_MATCH=etag)
+        self._add_image()
+        new_image = self.client.get(reverse('image-list'), HTTP_IF_NONE_MATCH=enqueued['ETag'])
+        self.client.delete(reverse('image-detail', args=[self.image.id]))
+        deleted = self.client.get(reverse('image-list'), HTTP_IF_NONE_MATCH=new_image['ETag'])
+
+        self.assertEqual(enqueued.status_code, 200)
+        self.assertEqual(new_image.status_code, 200)
+        self.assertEqual(deleted.status_code, 200)
+
+    def test_image_list_etag_changes_when_an_image_is_replaced(self):
+        etag = self.client.get(reverse('image-list'))['ETag']
+        image_file = SimpleUploadedFile(name='other.jpg', content=self.image_content, content_type='image/jpeg')
+
+        self.client.patch(reverse('image-detail', args=[self.image.id]), {'image_file': image_file},
+                          format='multipart')
+
+        self.assertEqual(self.client.get(reverse('image-list'), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_image_list_etag_expires_with_presigned_urls(self):
+        with mock.patch('get_a_pic_app.views.url_lifetime', return_value=3600), \
+                mock.patch('get_a_pic_app.views.time.time', return_value=10 * 1800.0):
+            etag = self.client.get(reverse('image-list'))['ETag']
+            with mock.patch('get_a_pic_app.views.time.time', return_value=10 * 1800.0 + 1799):
+                same_period = self.client.get(reverse('image-list'), HTTP_IF_NONE_MATCH=etag)
+            with mock.patch('get_a_pic_app.views.time.time', return_value=11 * 1800.0):
+                next_period = self.client.get(reverse('image-list'), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(same_period.status_code, 304)
+        self.assertEqual(next_period.status_code, 200)
+
+    def test_thumbnail_url_is_immutable(self):
+        url = self.client.get(reverse('image-detail', args=[self.image.id])).data['thumbnails']['200']
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_thumbnail_url_negotiates_format(self):
+        url = self.client.get(reverse('image-detail', args=[self.image.id])).data['thumbnails']['200']
+
+        response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+
+    def test_stale_thumbnail_version_is_revalidated(self):
+        url = reverse('image-thumbnail', args=[self.image.id, 200])
+        response = self.client.get(url, {'v': '0' * 12})
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_original_url_is_versioned(self):
+        url = self.client.get(reverse('image-detail', args=[self.image.id])).data['image_file']
+        self.assertTrue(url.endswith(f"?v={self.image.content_hash[:12]}"))
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(b''.join(response.streaming_content), self.image_content)
+
+    def test_unversioned_media_is_revalidated(self):
+        response = self.client.get('/media/' + self.image.image_file.name)
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+
+    def test_stale_original_version_is_revalidated(self):
+        for version in ('0' * 12, self.image.content_hash[:11], 'anything'):
+            response = self.client.get('/media/' + self.image.image_file.name, {'v': version})
+            self.assertEqual(response['Cache-Control'], 'public, no-cache')
+
+
+class NegotiateFormatTest(TestCase):
+
+    def test_prefers_avif_over_webp(self):
+        self.assertEqual(negotiate_format('image/avif,image/webp,*/*', ['webp', 'avif']), 'avif')
+
+    def test_respects_plan_formats(self):
+        self.assertEqual(negotiate_format('image/avif,image/webp', ['webp']), 'webp')
+
+    def test_ignores_refused_types(self):
+        self.assertIsNone(negotiate_format('image/webp;q=0, image/jpeg', ['webp']))
+
+    def test_ignores_wildcards(self):
+        self.assertIsNone(negotiate_format('*/*', ['webp', 'avif']))
+
+
+@override_settings(PERF_INSTRUMENTATION_ENABLED=True)
+class PerformanceMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(user=self.user)
+        size_200 = ThumbnailSize.objects.create(size=200)
+        plan = Plan.objects.create(name='Basic')
+        plan.thumbnail_sizes.add(size_200)
+        self.user.profile.plan = plan
+        self.user.profile.save()
+
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+        with open(image_path, 'rb') as img_file:
+            image_file = SimpleUploadedFile(name='test_image.jpg', content=img_file.read(), content_type='image/jpeg')
+        self.image = Image.objects.create(user=self.user, image_file=image_file)
+
+    def _timings(self, response):
+        return {entry.split(';')[0]: entry for entry in response['Server-Timing'].split(', ')}
+
+    def test_server_timing_reports_queries_and_serialization(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('image-list'))
+
+        timings = self._timings(response)
+        self.assertIn(f'desc="{len(context.captured_queries)} queries"', timings['db'])
+        self.assertIn('serialize', timings)
+        self.assertIn('total', timings)
+
+    def test_server_timing_reports_thumbnail_rendering(self):
+        response = self.client.get(reverse('image-thumbnail', args=[self.image.id, 200]))
+
+        timings = self._timings(response)
+        for span in ('create_thumbnails', 'pil_decode', 'pil_resize', 'pil_encode'):
+            self.assertIn(span, timings)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('image-list'))
+
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('getapic_requests_total{method="GET",status="200",view="image-list"}', body)
+        self.assertIn('getapic_span_duration_seconds_count{span="serialize"}', body)
+        self.assertIn('# TYPE getapic_storage_files_deleted_total counter', body)
+
+    @override_settings(PERF_METRICS_ALLOWED_IPS=[])
+    def test_metrics_endpoint_is_local_only(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    def test_slow_sampled_requests_are_profiled(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with self.settings(PERF_PROFILE_SAMPLE_RATE=1.0, PERF_SLOW_REQUEST_THRESHOLD=0,
+                               PERF_PROFILE_DIR=profile_dir):
+                self.client.get(reverse('image-list'))
+            self.assertEqual(len(os.listdir(profile_dir)), 1)
+
+    @override_settings(PERF_INSTRUMENTATION_ENABLED=False)
+    def test_disabled_by_default(self):
+        response = APIClient().get(reverse('main-page'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(APIClient().get(reverse('metrics')).status_code, 404)
@@ -0,0 +1,40 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingMemoryFileUploadHandler(MemoryFileUploadHandler):
+    """Keep small uploads in memory and hash them while they arrive."""
+
+    def new_file(self, *args, **kwargs):
+        # The parent raises StopFutureHandlers once it takes the file, so set up the hasher first.
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_hash = self.hasher.hexdigest()
+        return file
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Spool larger uploads to a temporary file chunk by chunk and hash them on the way through."""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.content_hash = self.hasher.hexdigest()
+        return file
@@ -1,7 +1,9 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserProfileViewSet, ImageViewSet, MainPageView, PlanViewSet, ThumbnailSizeViewSet,ExpiringLinkViewSet
+from .views import UserProfileViewSet, ImageViewSet, MainPageView, PlanViewSet, ThumbnailSizeViewSet,ExpiringLinkViewSet, \
+    metrics_view
 from django.contrib.auth import views as auth_views
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'userprofile', UserProfileViewSet)
@@ -14,5 +16,12 @@ router.register(r'expiring-link', ExpiringLinkViewSet)
 urlpatterns = [
     path('', MainPageView.as_view(), name='main-page'),
     path('api/', include(router.urls)),
+    path('metrics', metrics_view, name='metrics'),
+    path('async/images/<int:pk>/thumbnail/<int:size>/', async_views.image_thumbnail, name='async-image-thumbnail'),
+    path('async/images/<int:pk>/original/', async_views.image_original, name='async-image-original'),
+    path('async/expiring-link/retrieve/<str:token>/', async_views.retrieve_by_token,
+         name='async-expiringlink-retrieve-by-token'),
+    path('async/expiring-link/signed/<str:token>/', async_views.retrieve_signed,
+         name='async-expiringlink-retrieve-signed'),
     path('login/', auth_views.LoginView.as_view(template_name='admin/login.html'), name='login'),
 ]
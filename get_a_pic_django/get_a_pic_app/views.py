@@ -1,39 +1,97 @@
-import io
-import os.path
+import hashlib
 import secrets
+import time
 from datetime import timedelta
 from django.urls import reverse
 from rest_framework import viewsets, views, status
-from .models import UserProfile, Image, Plan, ThumbnailSize, ExpiringLink
-from .serializers import UserProfileSerializer, ImageSerializer, PlanSerializer, \
-    ThumbnailSizeSerializer, ExpiringLinkSerializer
-from django.http import HttpResponse, FileResponse
+from .models import UserProfile, Image, Plan, ThumbnailSize, Thumbnail, ExpiringLink
+from .serializers import UserProfileSerializer, ImageSerializer, ImageFilterSerializer, PlanSerializer, \
+    PlanAssignmentSerializer, ThumbnailSizeSerializer, ExpiringLinkSerializer
+from django.http import Http404, HttpResponse
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework.decorators import action
+from rest_framework.negotiation import BaseContentNegotiation
 from rest_framework.reverse import reverse
 from django.utils import timezone
-from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Count, Prefetch, prefetch_related_objects
+from .downloads import guess_content_type, negotiate_format, patch_thumbnail_caching, serve_file
+from .entitlements import get_entitlements
+from .link_cache import resolve_link
+from .metrics import render_metrics
+from .pagination import UploadedAtCursorPagination
+from .signed_links import make_signed_link, resolve_signed_link
+from .storage import is_versioned_name, thumbnail_storage, url_lifetime
+from .tasks import change_plan, enqueue_thumbnails_bulk, get_or_render_thumbnail, get_or_render_variant
 
 
-class UserProfileViewSet(viewsets.ModelViewSet):
+class FileContentNegotiation(BaseContentNegotiation):
+    """Pick the first renderer regardless of Accept; file views answer image requests themselves."""
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class EntitlementsContextMixin:
+    """Pass the requesting user's cached plan entitlements to the serializers."""
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['entitlements'] = get_entitlements(self.request.user)
+        return context
+
+
+def image_queryset():
+    return Image.objects.select_related('user').prefetch_related('thumbnails__thumbnail_size')
+
+
+class UserProfileViewSet(EntitlementsContextMixin, viewsets.ModelViewSet):
     queryset = UserProfile.objects.none()
     serializer_class = UserProfileSerializer
     permission_classes = [IsAuthenticated]
+    # The profile only embeds the most recent images; the full library is paginated under /api/images/.
+    recent_images_count = 20
 
     def get_queryset(self):
-        return UserProfile.objects.filter(user=self.request.user)
+        recent_images = image_queryset().order_by('-uploaded_at', '-id')[:self.recent_images_count]
+        return UserProfile.objects.filter(user=self.request.user).select_related('user', 'plan') \
+            .annotate(images_count=Count('user__images')) \
+            .prefetch_related('plan__thumbnail_sizes',
+                              Prefetch('user__images', queryset=recent_images, to_attr='recent_images'))
 
 
-class ImageViewSet(viewsets.ModelViewSet):
+class ImageViewSet(EntitlementsContextMixin, viewsets.ModelViewSet):
     queryset = Image.objects.none()
     serializer_class = ImageSerializer
     parser_classes = (MultiPartParser, FormParser)
     permission_classes = [IsAuthenticated]
+    pagination_class = UploadedAtCursorPagination
 
     def get_queryset(self):
-        return Image.objects.filter(user=self.request.user)
+        return image_queryset().filter(user=self.request.user)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action == 'list':
+            filters = ImageFilterSerializer(data=self.request.query_params)
+            filters.is_valid(raise_exception=True)
+            queryset = filters.filter(queryset)
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        fields = self.request.query_params.get('fields')
+        if fields and self.request.method == 'GET':
+            context['fields'] = set(fields.split(','))
+        return context
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -41,12 +99,126 @@ class ImageViewSet(viewsets.ModelViewSet):
         serializer.save(user=self.request.user)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    def list_etag(self, request):
+        """
+        A fingerprint of everything a page of the list depends on: the user's library version, bumped by every
+        write to their images and thumbnails, the plan and the exact URL (page, fields, host) and renderer.
+        It is read by primary key, so revalidating costs the same whatever the size of the library.
+
+        When the originals are linked through presigned URLs, the fingerprint also changes every half of their
+        lifetime, so a page confirmed by a 304 never holds URLs with less than half of it left.
+        """
+        version = UserProfile.objects.filter(user_id=request.user.pk) \
+            .values_list('library_version', flat=True).first()
+        lifetime = url_lifetime(default_storage)
+        url_period = int(time.time() // (lifetime / 2)) if lifetime else None
+        fingerprint = repr((request.user.pk, version, get_entitlements(request.user), request.build_absolute_uri(),
+                            request.accepted_media_type, url_period))
+        return f'"{hashlib.md5(fingerprint.encode(), usedforsecurity=False).hexdigest()}"'
+
+    def list(self, request, *args, **kwargs):
+        # Polling clients revalidate with If-None-Match and get a 304 without the page being queried or serialized.
+        etag = self.list_etag(request)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+            response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    @action(detail=True, methods=['get'], url_path=r'thumbnail/(?P<size>\d+)', name='thumbnail',
+            content_negotiation_class=FileContentNegotiation)
+    def thumbnail(self, request, pk=None, size=None):
+        image = self.get_object()
+        entitlements = get_entitlements(request.user)
+        thumbnail_size = entitlements.get_thumbnail_size(int(size))
+        if thumbnail_size is None:
+            return Response({"detail": "This thumbnail size is not available on your plan"},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        thumbnail = get_or_render_thumbnail(image, thumbnail_size)
+        if thumbnail.status != Thumbnail.READY:
+            # Too large to render inline; a large-image worker has it.
+            return Response({"detail": "The thumbnail is being rendered, try again shortly"},
+                            status=status.HTTP_202_ACCEPTED, headers={'Retry-After': '10'})
+        file_path = thumbnail.file_path
+        fmt = negotiate_format(request.META.get('HTTP_ACCEPT', ''), entitlements.thumbnail_formats)
+        if fmt is not None:
+            file_path = get_or_render_variant(thumbnail, fmt, entitlements.thumbnail_quality).file_path
+
+        response = serve_file(request, thumbnail_storage(), file_path, guess_content_type(file_path))
+        patch_thumbnail_caching(request, response, thumbnail)
+        return response
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_upload(self, request):
+        uploads = request.FILES.getlist('image_files')
+        if not uploads:
+            return Response({"image_files": ["No files were submitted."]}, status=status.HTTP_400_BAD_REQUEST)
+        if len(uploads) > settings.BULK_UPLOAD_MAX_FILES:
+            return Response({"image_files": [f"At most {settings.BULK_UPLOAD_MAX_FILES} files per request."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = []
+        valid_uploads = []
+        for upload in uploads:
+            serializer = self.get_serializer(data={'image_file': upload})
+            if serializer.is_valid():
+                valid_uploads.append(upload)
+                results.append(None)
+            else:
+                results.append({"name": upload.name, "status": status.HTTP_400_BAD_REQUEST,
+                                "errors": serializer.errors})
+
+        images = []
+        if valid_uploads:
+            thumbnail_sizes = get_entitlements(request.user).thumbnail_sizes
+            with transaction.atomic():
+                images = Image.from_uploads(request.user, valid_uploads)
+                Image.objects.bulk_create(images)
+                UserProfile.bump_library_version([request.user.pk])
+                enqueue_thumbnails_bulk(images, list(thumbnail_sizes))
+            prefetch_related_objects(images, 'thumbnails__thumbnail_size')
+
+        created = iter(self.get_serializer(images, many=True).data)
+        for index, upload in enumerate(uploads):
+            if results[index] is None:
+                results[index] = {"name": upload.name, "status": status.HTTP_201_CREATED, "image": next(created)}
+
+        if not valid_uploads:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif len(valid_uploads) < len(uploads):
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response({"results": results}, status=response_status)
+
 
 class PlanViewSet(viewsets.ModelViewSet):
     queryset = Plan.objects.all()
     serializer_class = PlanSerializer
     permission_classes = [IsAdminUser]
 
+    @action(detail=True, methods=['post'], url_path='assign-users', serializer_class=PlanAssignmentSerializer)
+    def assign_users(self, request, pk=None):
+        """
+        Move users to this plan in batches: the given `users`, every user on `from_plan`, or both. Thumbnails of sizes
+        the plan does not include are deleted and only the sizes the users' images are missing are queued.
+        """
+        plan = self.get_object()
+        serializer = PlanAssignmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        profiles = UserProfile.objects.none()
+        if 'users' in serializer.validated_data:
+            profiles |= UserProfile.objects.filter(user_id__in=serializer.validated_data['users'])
+        if 'from_plan' in serializer.validated_data:
+            profiles |= UserProfile.objects.filter(plan=serializer.validated_data['from_plan'])
+        user_ids = list(profiles.exclude(plan=plan).values_list('user_id', flat=True))
+
+        moved, removed, queued = change_plan(user_ids, plan)
+        return Response({'users': moved, 'thumbnails_removed': removed, 'thumbnails_queued': queued})
+
 
 class ThumbnailSizeViewSet(viewsets.ModelViewSet):
     queryset = ThumbnailSize.objects.all()
@@ -69,6 +241,42 @@ class MainPageView(views.APIView):
         return HttpResponse(content, content_type='text/html')
 
 
+def is_current_version(name, version):
+    """Whether `version` is the content hash `VersionedImageField` links the original stored as `name` with."""
+    if not version or len(version) != 12:
+        return False
+    return Image.objects.filter(image_file=name, content_hash__startswith=version).exists()
+
+
+def media_file(request, name):
+    """
+    Files under MEDIA_URL, with ETags, conditional requests and caching headers.
+
+    Thumbnail names carry a digest of their content and originals are linked with their content hash as `v`;
+    those URLs never change meaning and are cacheable for MEDIA_IMMUTABLE_MAX_AGE. Anything else, including a `v`
+    that is not the current hash of the file, is revalidated.
+    """
+    content_type = guess_content_type(name)
+    if content_type is None:
+        raise Http404()
+    storage = thumbnail_storage() if name.startswith('thumbnails/') else default_storage
+    response = serve_file(request, storage, name, content_type)
+    if is_versioned_name(name) or is_current_version(name, request.GET.get('v')):
+        patch_cache_control(response, public=True, max_age=settings.MEDIA_IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+    return response
+
+
+def metrics_view(request):
+    """Prometheus metrics of this process; only served with instrumentation enabled, to PERF_METRICS_ALLOWED_IPS."""
+    if not settings.PERF_INSTRUMENTATION_ENABLED:
+        raise Http404()
+    if request.META.get('REMOTE_ADDR') not in settings.PERF_METRICS_ALLOWED_IPS:
+        raise Http404()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class ExpiringLinkViewSet(viewsets.ModelViewSet):
     queryset = ExpiringLink.objects.all()
     serializer_class = ExpiringLinkSerializer
@@ -76,7 +284,7 @@ class ExpiringLinkViewSet(viewsets.ModelViewSet):
 
     def create(self, request, *args, **kwargs):
 
-        if request.user.profile.plan.name != 'Enterprise':
+        if not get_entitlements(request.user).can_generate_expiring_link:
             return Response({"detail": "Unauthorized"}, status=status.HTTP_403_FORBIDDEN)
 
         serializer = self.get_serializer(data=request.data)
@@ -91,6 +299,11 @@ class ExpiringLinkViewSet(viewsets.ModelViewSet):
         except Image.DoesNotExist:
             return Response({"detail": "Image with provided ID does not exist"}, status=status.HTTP_400_BAD_REQUEST)
 
+        if serializer.validated_data.get('mode', settings.EXPIRING_LINK_MODE) == 'signed':
+            token = make_signed_link(image_instance, expiration_seconds)
+            base_url = reverse('expiringlink-retrieve-signed', args=[token], request=request)
+            return Response({"link": base_url}, status=status.HTTP_201_CREATED)
+
         token = secrets.token_urlsafe(25)
         base_url = reverse('expiringlink-retrieve-by-token', args=[token], request=request)
 
@@ -103,24 +316,28 @@ class ExpiringLinkViewSet(viewsets.ModelViewSet):
 
         return Response({"link": base_url}, status=status.HTTP_201_CREATED)
 
-    @action(detail=False, methods=['get'], url_path='retrieve/(?P<token>[^/.]+)', name='retrieve-by-token')
+    @action(detail=False, methods=['get'], url_path='retrieve/(?P<token>[^/.]+)', name='retrieve-by-token',
+            content_negotiation_class=FileContentNegotiation)
     def retrieve_by_token(self, request, token=None):
-        expiring_link = get_object_or_404(ExpiringLink, link=token)
+        link = resolve_link(token)
+        if link is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        if expiring_link.is_expired():
-            return Response({"detail": "Link has expired"}, status=status.HTTP_404_NOT_FOUND)
+        if link.content_type is None:
+            return Response({"detail": "Unsupported image format"}, status=status.HTTP_400_BAD_REQUEST)
 
-        image_path = expiring_link.image.image_file.path
-        _, extension = os.path.splitext(image_path)
+        return serve_file(request, default_storage, link.name, link.content_type)
 
-        if extension.lower() in ['.jpeg', '.jpg']:
-            content_type = 'image/jpeg'
-        elif extension.lower() == '.png':
-            content_type = 'image/png'
-        else:
-            return Response({"detail": "Unsupported image format"}, status=status.HTTP_400_BAD_REQUEST)
+    @action(detail=False, methods=['get'], url_path='signed/(?P<token>[^/]+)', name='retrieve-signed',
+            permission_classes=[AllowAny], authentication_classes=[],
+            content_negotiation_class=FileContentNegotiation)
+    def retrieve_signed(self, request, token=None):
+        # The token is the credential: no session or user lookup, and no link row.
+        link = resolve_signed_link(token)
+        if link is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        with open(image_path, 'rb') as file:
-            content = file.read()
+        if link.content_type is None:
+            return Response({"detail": "Unsupported image format"}, status=status.HTTP_400_BAD_REQUEST)
 
-        return FileResponse(io.BytesIO(content), content_type=content_type)
+        return serve_file(request, default_storage, link.name, link.content_type)
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'get_a_pic_app.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -116,6 +117,132 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, "get_a_pic_app/static")]
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Uploads
+# Uploads are hashed chunk by chunk as they arrive. Anything over FILE_UPLOAD_MAX_MEMORY_SIZE is spooled
+# to a temporary file, which storage then moves into place, so memory per upload stays bounded.
+# Images over IMAGE_MAX_PIXELS are rejected from their header, before any pixel data is decoded.
+
+FILE_UPLOAD_HANDLERS = [
+    'get_a_pic_app.uploadhandlers.HashingMemoryFileUploadHandler',
+    'get_a_pic_app.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440
+IMAGE_MAX_PIXELS = 150000000
+BULK_UPLOAD_MAX_FILES = 500
+DATA_UPLOAD_MAX_NUMBER_FILES = BULK_UPLOAD_MAX_FILES
+
+# Thumbnail rendering queue
+# Uploads only enqueue thumbnails; `manage.py run_thumbnail_worker` renders them.
+# Set THUMBNAIL_TASKS_EAGER to render right after the upload commits, without a worker. Eager renders run one after
+# another in the request that uploaded; THUMBNAIL_WORKER_PROCESSES only sizes the worker and backfill pools.
+
+THUMBNAIL_TASKS_EAGER = False
+THUMBNAIL_WORKER_PROCESSES = 2
+THUMBNAIL_TASK_MAX_ATTEMPTS = 3
+# Workers touch their running task every THUMBNAIL_TASK_HEARTBEAT seconds, however long the render takes. A task
+# without a heartbeat for THUMBNAIL_TASK_TIMEOUT seconds lost its worker: it is queued again, or failed once it
+# has had THUMBNAIL_TASK_MAX_ATTEMPTS attempts.
+THUMBNAIL_TASK_HEARTBEAT = 60
+THUMBNAIL_TASK_TIMEOUT = 300
+# Memory a render may use to decode an original, in bytes, checked from the image header. JPEGs are decoded at
+# a reduced scale first; originals that still do not fit go to the 'large' queue, which only workers started with
+# `run_thumbnail_worker --queue large` take, under THUMBNAIL_LARGE_MEMORY_BUDGET (None: no limit).
+THUMBNAIL_MEMORY_BUDGET = 256 * 1024 * 1024
+THUMBNAIL_LARGE_MEMORY_BUDGET = None
+# Users moved per transaction by a bulk plan change (POST /api/plans/<id>/assign-users/).
+PLAN_CHANGE_BATCH_SIZE = 500
+
+# Storage
+# Originals use the 'default' storage and thumbnails the 'thumbnails' one. Both spread files over hashed
+# subdirectories of MEDIA_ROOT. For several nodes, point them at an S3-compatible bucket in local_settings.py:
+#     'BACKEND': 'get_a_pic_app.storage.S3Storage',
+#     'OPTIONS': {'bucket_name': 'get-a-pic', 'endpoint_url': 'http://minio:9000', ...}
+# Keep 'file_overwrite': True in the thumbnails OPTIONS only. Thumbnail names carry a digest of their content, so
+# overwriting one rewrites the same bytes; originals with the same upload name must get unique names instead.
+# MmapFileSystemStorage maps files into memory when reading them for thumbnailing.
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'get_a_pic_app.storage.ShardedFileSystemStorage',
+    },
+    'thumbnails': {
+        'BACKEND': 'get_a_pic_app.storage.ShardedFileSystemStorage',
+        'OPTIONS': {'file_overwrite': True},
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# File delivery
+# 'direct' streams files from disk (sendfile through wsgi.file_wrapper when the server supports it) or object storage.
+# 'redirect' sends clients to the storage URL (e.g. a presigned S3 URL).
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd) hands the transfer to the front-end server;
+# for nginx, map FILE_DELIVERY_ACCEL_PREFIX to MEDIA_ROOT with an `internal` location.
+
+FILE_DELIVERY_MODE = 'direct'
+FILE_DELIVERY_ACCEL_PREFIX = '/protected-media/'
+
+# Media URLs are served by the app (or offloaded as above) with ETags and Cache-Control. Thumbnail names carry a
+# digest of their content and original URLs their content hash, so both are cached as immutable for
+# MEDIA_IMMUTABLE_MAX_AGE seconds by browsers and CDNs. Set SERVE_MEDIA = False when the front-end server serves
+# MEDIA_ROOT itself.
+SERVE_MEDIA = True
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Caching
+# Point CACHES at Redis or Memcached in local_settings.py to share cached data between processes and nodes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Expiring-link token resolution: an in-process LRU in front of the shared cache.
+# Positive entries never outlive the link's expiration_date.
+
+LINK_CACHE_TIMEOUT = 3600
+LINK_CACHE_NEGATIVE_TIMEOUT = 30
+LINK_CACHE_LOCAL_TIMEOUT = 60
+LINK_CACHE_LOCAL_MAXSIZE = 10000
+
+# Expired links are only filtered out on lookup; `manage.py purge_expired_links` (e.g. hourly from cron) deletes
+# them in batches of EXPIRING_LINK_PURGE_BATCH_SIZE rows.
+EXPIRING_LINK_PURGE_BATCH_SIZE = 1000
+# The purge runs in its own short-lived process, so its getapic_expired_links_purged_total never reaches the web
+# process's /metrics. Point this (or `--metrics-file`) at a *.prom file in node_exporter's textfile collector
+# directory to export the running total from there instead.
+EXPIRING_LINK_PURGE_METRICS_FILE = None
+
+# Expiring links are either stored rows ('db') or self-contained tokens signed with SIGNED_LINK_KEY ('signed'),
+# which are served without any database query. Clients may pick per link; this is the default.
+# SIGNED_LINK_KEY falls back to SECRET_KEY. To revoke all signed links, set a new key; to rotate without revoking,
+# also list the old key in SIGNED_LINK_FALLBACK_KEYS until its links have expired.
+EXPIRING_LINK_MODE = 'db'
+SIGNED_LINK_KEY = None
+SIGNED_LINK_FALLBACK_KEYS = []
+
+# Plan entitlements (sizes, original links, expiring links, formats) compiled per plan, plus each user's plan id.
+# Plan, ThumbnailSize and UserProfile changes evict them through signals; the in-process tier of other processes
+# catches up within ENTITLEMENTS_LOCAL_TIMEOUT.
+
+ENTITLEMENTS_CACHE_TIMEOUT = 3600
+ENTITLEMENTS_LOCAL_TIMEOUT = 60
+ENTITLEMENTS_LOCAL_MAXSIZE = 10000
+
+# Performance instrumentation
+# When enabled, responses carry a Server-Timing header (SQL, thumbnail rendering, PIL and serializer time) and
+# /metrics serves per-process Prometheus metrics to the listed addresses. A PERF_PROFILE_SAMPLE_RATE share of
+# requests is run under cProfile; profiles of requests slower than PERF_SLOW_REQUEST_THRESHOLD seconds are kept.
+# The middleware is synchronous: under ASGI it makes the async views run in a thread again.
+
+PERF_INSTRUMENTATION_ENABLED = False
+PERF_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+PERF_PROFILE_SAMPLE_RATE = 0.0
+PERF_SLOW_REQUEST_THRESHOLD = 1.0
+PERF_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
 
 try:
     from .local_settings import *
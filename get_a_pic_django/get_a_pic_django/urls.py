@@ -14,15 +14,19 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+from get_a_pic_app.views import media_file
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('get_a_pic_app.urls')),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+if settings.SERVE_MEDIA and settings.MEDIA_URL.startswith('/'):
+    urlpatterns += [
+        re_path(r'^%s(?P<name>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), media_file, name='media'),
+    ]
\ No newline at end of file